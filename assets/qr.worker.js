@@ -0,0 +1,36 @@
+// Web Worker that decodes QR codes in the browser for the play page.
+// It is excluded from the automatically loaded assets (see assets_ignore in index.py) and is started by the scan
+// callback of the play page when the browser decode mode is enabled.
+let detector = null;
+
+self.onmessage = async (event) => {
+    const { bitmap, crop, size } = event.data;
+    try {
+        if (!detector) {
+            const supported = 'BarcodeDetector' in self
+                && (await BarcodeDetector.getSupportedFormats()).includes('qr_code');
+            if (!supported) {
+                bitmap.close();
+                self.postMessage({ unsupported: true });  // The page falls back to the server-side decoding
+                return;
+            }
+            detector = new BarcodeDetector({ formats: ['qr_code'] });
+        }
+
+        // Center-crop and downscale the frame the same way the server-side path does
+        const side = Math.min(bitmap.width, bitmap.height) * crop;
+        const scale = Math.min(1, size / side);
+        const canvas = new OffscreenCanvas(Math.round(side * scale), Math.round(side * scale));
+        canvas.getContext('2d').drawImage(
+            bitmap,
+            (bitmap.width - side) / 2, (bitmap.height - side) / 2, side, side,
+            0, 0, canvas.width, canvas.height
+        );
+        bitmap.close();
+
+        const codes = await detector.detect(canvas);
+        self.postMessage({ data: codes.length > 0 ? codes[0].rawValue : null });
+    } catch (err) {
+        self.postMessage({ error: String(err) });
+    }
+};
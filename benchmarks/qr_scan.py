@@ -0,0 +1,211 @@
+import re
+import cv2
+import time
+import itertools
+import numpy as np
+import pandas as pd
+from config import VibesterConfig
+from generator.table import Table
+from generator.track import Track
+from typing import List, Tuple, Dict
+from pages.play.scanner import scan_job
+from pages.generate.utils import calculate_hash
+
+
+def rasterize_page(svg: str, px_per_mm: float) -> np.ndarray:
+    """
+    Rasterizes the QR side of a page rendered by Table.render_svg into a grayscale image.
+    Only the elements the QR side consists of are drawn: the QR code paths, the grid and the crop marks.
+    """
+    page = np.full((round(297 * px_per_mm), round(210 * px_per_mm)), 255, np.uint8)
+    thickness = max(1, round(0.2 * px_per_mm))
+
+    for x1, y1, x2, y2 in re.findall(r'<line x1="([\d.]+)" y1="([\d.]+)" x2="([\d.]+)" y2="([\d.]+)"', svg):
+        p1 = (round(float(x1) * px_per_mm), round(float(y1) * px_per_mm))
+        p2 = (round(float(x2) * px_per_mm), round(float(y2) * px_per_mm))
+        cv2.line(page, p1, p2, 0, thickness)
+
+    for tx, ty, path in re.findall(r'<g transform="translate\(([\d.]+), ([\d.]+)\)">\s*<path[^>]* d="([^"]+)"', svg):
+        for x0, y0, x1, y1 in re.findall(r"M([\d.]+),([\d.]+)H([\d.]+)V([\d.]+)H[\d.]+z", path):
+            p0 = (round((float(tx) + float(x0)) * px_per_mm), round((float(ty) + float(y0)) * px_per_mm))
+            p1 = (round((float(tx) + float(x1)) * px_per_mm) - 1, round((float(ty) + float(y1)) * px_per_mm) - 1)
+            cv2.rectangle(page, p0, p1, 0, -1)
+    return page
+
+
+def get_card_centers(table: Table) -> List[Tuple[float, float]]:
+    """
+    Returns the centers (in mm) of the QR codes on the QR side of a page, in the order of the tracks of the table.
+    Mirrors the layout of Table.render_svg.
+    """
+    side_mm = 62
+    hmargin_mm = (210 - side_mm * table.width) / 2
+    centers = []
+    for i in range(len(table.cells)):
+        ix = table.width - 1 - (i % table.width)
+        iy = i // table.width
+        centers.append((hmargin_mm + (ix + 0.5) * side_mm, hmargin_mm + (iy + 0.5) * side_mm))
+    return centers
+
+
+def make_frame(
+    page: np.ndarray,
+    center_mm: Tuple[float, float],
+    px_per_mm: float,
+    resolution: Tuple[int, int],
+    rotation: float,
+    blur: float,
+    glare: float,
+    noise: float,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """
+    Composites a synthetic camera frame of a card: the card is cut out of the page, placed on a darker table, rotated
+    and scaled so it fills about half of the shorter side of the frame, then blur, a glare spot and sensor noise are
+    applied.
+    """
+    width, height = resolution
+    side_px = round(62 * px_per_mm)
+    x0, y0 = round(center_mm[0] * px_per_mm - side_px / 2), round(center_mm[1] * px_per_mm - side_px / 2)
+    card = page[y0:y0 + side_px, x0:x0 + side_px]
+
+    scale = 0.5 * min(width, height) / side_px
+    matrix = cv2.getRotationMatrix2D((side_px / 2, side_px / 2), rotation, scale)
+    matrix[:, 2] += (width / 2 - side_px / 2, height / 2 - side_px / 2)  # Move the card to the center of the frame
+    matrix[:, 2] += rng.uniform(-0.1, 0.1, 2) * (width, height)  # The card is rarely held at the exact center
+    frame = cv2.warpAffine(card, matrix, (width, height), flags=cv2.INTER_AREA, borderValue=90).astype(np.float32)
+
+    if blur > 0:
+        frame = cv2.GaussianBlur(frame, (0, 0), sigmaX=blur * min(width, height) / 480)
+    if glare > 0:
+        gx, gy = rng.uniform(0.3, 0.7) * width, rng.uniform(0.3, 0.7) * height
+        yy, xx = np.mgrid[0:height, 0:width]
+        spot = np.exp(-((xx - gx) ** 2 + (yy - gy) ** 2) / (2 * (0.15 * min(width, height)) ** 2))
+        frame = frame + glare * 255 * spot
+    if noise > 0:
+        frame = frame + rng.normal(0, noise, frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def encode_frame(frame: np.ndarray) -> bytes:
+    """
+    Prepares a frame the way the play page does before uploading it: center crop, downscale and JPEG encoding.
+    """
+    height, width = frame.shape[:2]
+    side = round(min(width, height) * VibesterConfig.scan_frame_crop)
+    x0, y0 = (width - side) // 2, (height - side) // 2
+    frame = frame[y0:y0 + side, x0:x0 + side]
+    if side > VibesterConfig.scan_frame_size:
+        size = VibesterConfig.scan_frame_size
+        frame = cv2.resize(frame, (size, size), interpolation=cv2.INTER_AREA)
+    quality = int(VibesterConfig.scan_jpeg_quality * 100)
+    return cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def run_benchmark(
+    resolutions: List[Tuple[int, int]],
+    rotations: List[float],
+    blurs: List[float],
+    glares: List[float],
+    noises: List[float],
+    frames_per_condition: int,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Renders a page of cards, scans synthetic frames of them for every combination of the conditions and returns
+    one row per frame with the outcome and the latency of the decode path of the scan endpoint.
+    Frames where the code was located are scanned once more with the bounding box as the region of interest, which is
+    how the scanner follows a card held in front of the camera.
+    """
+    rng = np.random.default_rng(seed)
+    table = Table()
+    for i in range(table.width * table.height):
+        table.append(Track(track={
+            "year": 1950 + i,
+            "artist": f"Artist {i}",
+            "title": f"Title {i}",
+            "hash": calculate_hash(f"artist{i}title{i}{1950 + i}"),
+        }))
+
+    px_per_mm = 12
+    page = rasterize_page(svg=table.render_svg(mode="qr", page_footer=""), px_per_mm=px_per_mm)
+    centers = get_card_centers(table=table)
+
+    rows: List[Dict] = []
+    for resolution, rotation, blur, glare, noise in itertools.product(resolutions, rotations, blurs, glares, noises):
+        for _ in range(frames_per_condition):
+            card = int(rng.integers(len(table.cells)))
+            frame = make_frame(
+                page=page,
+                center_mm=centers[card],
+                px_per_mm=px_per_mm,
+                resolution=resolution,
+                rotation=rotation + rng.uniform(-3, 3),
+                blur=blur,
+                glare=glare,
+                noise=noise,
+                rng=rng,
+            )
+            frame_bytes = encode_frame(frame=frame)
+
+            start = time.perf_counter()
+            data, bbox = scan_job(frame=frame_bytes, width=None, height=None)
+            latency_ms = 1000 * (time.perf_counter() - start)
+
+            tracked, tracked_latency_ms = np.nan, np.nan
+            if bbox is not None:
+                start = time.perf_counter()
+                tracked_data, _ = scan_job(frame=frame_bytes, width=None, height=None, roi=bbox)
+                tracked_latency_ms = 1000 * (time.perf_counter() - start)
+                tracked = float(tracked_data == table.cells[card].hash)
+
+            rows.append({
+                "resolution": f"{resolution[0]}x{resolution[1]}",
+                "rotation": rotation,
+                "blur": blur,
+                "glare": glare,
+                "noise": noise,
+                "decoded": data == table.cells[card].hash,
+                "located": bbox is not None,
+                "latency_ms": latency_ms,
+                "tracked": tracked,
+                "tracked_latency_ms": tracked_latency_ms,
+                "frame_kb": len(frame_bytes) / 1024,
+            })
+    return pd.DataFrame(rows)
+
+
+def summarize(df: pd.DataFrame, by: str) -> pd.DataFrame:
+    """
+    Aggregates the benchmark results by one of the conditions: decode rate and latency percentiles.
+    """
+    return df.groupby(by).agg(
+        frames=("decoded", "size"),
+        decode_rate=("decoded", "mean"),
+        locate_rate=("located", "mean"),
+        latency_ms_mean=("latency_ms", "mean"),
+        latency_ms_p95=("latency_ms", lambda x: x.quantile(0.95)),
+        tracked_rate=("tracked", "mean"),
+        tracked_latency_ms_mean=("tracked_latency_ms", "mean"),
+        frame_kb=("frame_kb", "mean"),
+    ).round(3)
+
+
+if __name__ == "__main__":
+    # Scanner benchmark, runs fully offline. Change the detector settings in VibesterConfig and compare the output.
+    # Usage: python -m benchmarks.qr_scan from the root of the repository.
+    df_results = run_benchmark(
+        resolutions=[(640, 480), (1280, 720), (1920, 1080)],
+        rotations=[0, 20, 45],
+        blurs=[0, 0.75, 1.5],
+        glares=[0, 0.6],
+        noises=[0, 10],
+        frames_per_condition=5,
+    )
+
+    print(f"Frames: {len(df_results)}, decode rate: {df_results['decoded'].mean():.3f}, "
+          f"mean latency: {df_results['latency_ms'].mean():.2f} ms, "
+          f"p95 latency: {df_results['latency_ms'].quantile(0.95):.2f} ms, "
+          f"mean tracked latency: {df_results['tracked_latency_ms'].mean():.2f} ms")
+    for condition in ["resolution", "rotation", "blur", "glare", "noise"]:
+        print(f"\n{summarize(df=df_results, by=condition).to_string()}")
@@ -2,9 +2,10 @@ from typing import List
 from dash import dcc
 
 
-def loading(name: str, page: str, children: List = None) -> dcc.Loading:
+def loading(name: str, page: str, children: List = None, delay_show: int = 0) -> dcc.Loading:
     """
     Component that wraps other componenst and shows a loading animation while the callback is running.
+    Callbacks that finish within delay_show milliseconds don't show the animation.
     """
     if children is None:
         children = []
@@ -13,6 +14,7 @@ def loading(name: str, page: str, children: List = None) -> dcc.Loading:
         id={"name": name, "type": "dot-loading", "page": page},
         type="dot",
         color='#339c40',
+        delay_show=delay_show,
         style={
             "margin": "auto",
             "display": "flex",
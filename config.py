@@ -30,17 +30,67 @@ class VibesterConfig:
 
     # Fixed lists
     generate_table_cols = ["filename", "artist", "title", "year", "saved", "hash", "directory"]
+    generate_table_editable_cols = ["artist", "title", "year"]  # Tags printed on the cards, the other columns are kept
+    table_block_size = 100  # Rows of the music table the browser requests from the server at once
+    table_max_blocks = 10  # Blocks of rows the browser keeps, older ones are requested again when scrolled back to
+    table_max_views = 16  # Open generate pages whose sorted and filtered rows the server keeps for the next block
     supported_formats = [".mp3", ".mp4", ".ogg", ".wav", ".wma", ".m4a"]
     metadata_sources = ["musicbrainz", "spotify", "deezer", "discogs"]
     allowed_roles = ["admin", "user"]
 
     # Fixed locations
-    path_db = "data/db/db.pkl"
+    path_db = "data/db/catalog.db"
+    path_db_legacy = "data/db/db.pkl"  # Catalog of older versions, migrated into path_db on the first start
+    path_library = "data/db/library.pkl"
+    path_manifest = "data/db/manifest.pkl"
+    path_provider_cache = "data/db/providers.db"
+    path_fingerprints = "data/db/fingerprints.db"
+    path_jobs = "data/db/jobs.db"
+    path_musicbrainz_index = "data/db/musicbrainz.db"
     path_user = "data/user/user.pkl"
     path_output = "data/output"
     path_music = "data/music"
+    path_renditions = "data/renditions"
+    path_models = "data/models"
     path_cert = "data/cert"
 
+    # Music serving
+    music_mimetypes = {
+        ".mp3": "audio/mpeg",
+        ".mp4": "audio/mp4",
+        ".m4a": "audio/mp4",
+        ".ogg": "audio/ogg",
+        ".wav": "audio/wav",
+        ".wma": "audio/x-ms-wma",
+    }
+    music_max_age = 24 * 60 * 60  # Seconds the browsers may reuse a track without revalidating it
+    music_sendfile = None  # None serves the files from Flask, "x-accel" offloads to nginx, "x-sendfile" to Apache
+    music_accel_prefix = "/protected/music"  # Internal nginx location that maps to the music folder
+    renditions_accel_prefix = "/protected/renditions"  # Internal nginx location that maps to the renditions folder
+
+    # Streaming renditions, "format" and "codec" are passed to ffmpeg and "duration" (s) makes a preview clip
+    renditions = {
+        "stream": {"format": "ipod", "codec": "aac", "bitrate": 96, "extension": ".m4a", "duration": None},
+        "preview": {"format": "ipod", "codec": "aac", "bitrate": 64, "extension": ".m4a", "duration": 30},
+    }
+    default_rendition = "stream"  # Rendition the play page gets the address of once it is ready, None for originals
+    rendition_workers = 1  # Renditions transcoded at the same time
+
+    # Background jobs
+    job_workers = 1  # Worker processes running background jobs such as the rendering of decks
+    job_poll_interval = 1000  # Interval (ms) at which the pages poll the progress of a job
+    job_item_retention = 24 * 60 * 60  # Time (s) the partial results of a finished job are kept
+    library_scan_workers = 1  # Threads identifying new music files in the background, each with concurrent lookups
+    library_scan_checkpoint = 10  # Files identified between two saves of the scan manifest, at most lost on a restart
+
+    # Duplicate detection
+    duplicate_key_bits = 16  # Highest bits of each fingerprint value used as a key of the duplicate index
+    duplicate_num_perm = 64  # MinHash values of the key set of a fingerprint
+    duplicate_bands = 32  # Bands of the MinHash values, more bands find duplicates that share fewer keys
+    duplicate_min_similarity = 0.8  # Share of the fingerprint bits that match between duplicates
+    duplicate_min_overlap = 80  # Fingerprint values (about 10 s) duplicates must overlap by
+    duplicate_workers = 1  # Worker processes searching for duplicates, apart from the jobs so decks never wait on them
+
     # PDF generation
     grid = True
     crop_marks = True
@@ -50,11 +100,61 @@ class VibesterConfig:
     # Other settings
     hash_length = 30
     fingerprint_conf_threshold = 0.7
+    manifest_failure_ttl = 7 * 24 * 60 * 60  # Seconds before a file that could not be identified is tried again
+
+    # Metadata providers, requests per second and the size of the bursts allowed by the rate limiter of each provider
+    provider_rate_limits = {
+        "acoustid": {"rate": 3, "burst": 1},
+        "musicbrainz": {"rate": 3, "burst": 1},
+        "spotify": {"rate": 5, "burst": 5},
+        "deezer": {"rate": 10, "burst": 10},
+        "discogs": {"rate": 1, "burst": 1},
+    }
+    provider_connect_timeout = 5  # Seconds to connect to a provider
+    provider_read_timeout = 10  # Seconds to wait for the answer of a provider
+    provider_max_connections = 20  # Connections kept to the providers at the same time
+    provider_retries = 2  # Retries of a request that timed out or was answered with 429 or 5xx
+    provider_backoff = 1  # Seconds before the first retry, doubled for every further retry
+    provider_max_retry_wait = 30  # Requests that may only be retried later than this (s) are given up
+    provider_failure_threshold = 5  # Failed requests in a row after which a provider is skipped
+    provider_cooldown = 5 * 60  # Seconds a failing provider is skipped
+    metadata_concurrency = 8  # Tracks identified at the same time
+    discogs_max_results = 20  # Discogs search results compared with a track, read in a single request
+    provider_cache_ttl = {  # Seconds the answers of each provider are reused
+        "musicbrainz": 90 * 24 * 60 * 60,
+        "spotify": 30 * 24 * 60 * 60,
+        "deezer": 30 * 24 * 60 * 60,
+        "deezer_album": 365 * 24 * 60 * 60,  # Release dates of albums hardly ever change
+        "discogs": 30 * 24 * 60 * 60,
+    }
+    provider_cache_negative_ttl = 7 * 24 * 60 * 60  # Seconds a "no result" answer is reused
 
     # Video settings
     video_height = 480
     video_width = 360
 
+    # Scanner settings
+    scan_mode = "server"  # "server" decodes the frames on the server, "browser" decodes them in a Web Worker
+    scan_frame_size = 480  # Longest side (px) of the frames the play page uploads to the scan endpoint
+    scan_frame_crop = 0.8  # Ratio of the shorter video side that is center-cropped before downscaling
+    scan_jpeg_quality = 0.7  # JPEG quality of the uploaded frames
+    scan_max_frame_bytes = 2 * 1024 * 1024  # Frames larger than this are rejected
+    scan_workers = 2  # Worker processes decoding frames, this is the CPU ceiling of the scanner
+    scan_max_pending = 16  # Frames waiting for a worker before new frames are turned away
+    scan_timeout = 5  # Seconds a frame may wait for a worker and for its decoding
+    scan_detectors = ["opencv"]  # QR detector backends in order of preference: "wechat", "opencv", "zbar"
+    scan_detector_fallback = False  # Retry the frames the preferred backend could not decode with the other backends
+    scan_pyramid = [320]  # Longest sides of the downscaled levels of the frame the code is located on first
+    scan_roi_margin = 0.5  # Margin around the last bounding box of a session, relative to the size of the box
+    scan_dedup_size = 16  # Side length of the luminance signature used to recognise repeated frames
+    scan_dedup_threshold = 4.0  # Mean luminance difference (0-255) below which a frame without a code is a repeat
+    scan_dedup_sessions = 256  # Sessions whose last frame is remembered
+    scan_interval = 1000  # Base sampling interval (ms) of the play page
+    scan_interval_max = 4000  # Longest interval the sampling backs off to when nothing QR-like is seen
+    scan_interval_burst = 250  # Interval while a code that could not be decoded yet is in view
+    scan_idle_frames = 5  # Frames without anything QR-like after which the sampling starts backing off
+    scan_burst_frames = 8  # Frames sampled at the burst interval after a code was seen
+
     # Styles
     default_style_webcam_video = {
         "border-radius": "15px",
@@ -15,3 +15,17 @@ def robust(f: Callable) -> Callable:
             print(f"Error in {f.__name__}(args={args}, kwargs={kwargs})\n{e}")
             return None
     return wrapper
+
+
+def robust_async(f: Callable) -> Callable:
+    """
+    Counterpart of the robust wrapper for coroutine functions.
+    """
+    @wraps(f)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        try:
+            return await f(*args, **kwargs)
+        except Exception as e:
+            print(f"Error in {f.__name__}(args={args}, kwargs={kwargs})\n{e}")
+            return None
+    return wrapper
@@ -0,0 +1,147 @@
+import base64
+import itertools
+import numpy as np
+from config import VibesterConfig
+from collections import defaultdict
+from typing import Dict, List, Tuple, Set
+
+
+def unpack_ints(data: bytes, bits: int) -> np.ndarray:
+    """
+    Unpacks the unsigned integers of the given bit width that Chromaprint packs into bytes, lowest bits first.
+    """
+    stream = np.unpackbits(np.frombuffer(data, dtype=np.uint8), bitorder="little")
+    stream = stream[:len(stream) // bits * bits].reshape(-1, bits).astype(np.uint32)
+    return (stream << np.arange(bits, dtype=np.uint32)).sum(axis=1).astype(np.uint32)
+
+
+def decode_fingerprint(fingerprint: str) -> np.ndarray:
+    """
+    Decodes a compressed Chromaprint fingerprint, as returned by acoustid.fingerprint_file, into its 32-bit values,
+    about eight per second of audio. Each value is stored as the positions of the bits that changed since the
+    previous value, packed into 3-bit numbers with 5-bit extensions for the large ones.
+    """
+    data = base64.urlsafe_b64decode(fingerprint + "=" * (-len(fingerprint) % 4))
+    length = int.from_bytes(data[1:4], "big")  # The first byte is the version of the algorithm
+    if length == 0:
+        return np.zeros(0, dtype=np.uint32)
+
+    normal = unpack_ints(data=data[4:], bits=3)
+    ends = np.flatnonzero(normal == 0)  # Every value ends with a zero
+    if len(ends) < length:
+        raise ValueError("Truncated fingerprint")
+    normal = normal[:ends[length - 1] + 1]
+    offset = 4 + (len(normal) * 3 + 7) // 8
+    exceptional = normal == 7
+    normal[exceptional] += unpack_ints(data=data[offset:], bits=5)[:exceptional.sum()]
+
+    # The positions are deltas within each value, so the bit of an entry is its running sum since the last zero
+    ends = np.flatnonzero(normal == 0)
+    value_index = np.searchsorted(ends, np.arange(len(normal)))
+    running = np.cumsum(normal, dtype=np.int64)
+    bit = running - np.concatenate([[0], running[ends[:-1]]])[value_index]
+    changed = normal != 0
+    values = np.zeros(length, dtype=np.uint64)
+    np.bitwise_or.at(values, value_index[changed], np.left_shift(1, bit[changed] - 1).astype(np.uint64))
+    return np.bitwise_xor.accumulate(values.astype(np.uint32))  # The changes are relative to the previous value
+
+
+def compare_fingerprints(a: np.ndarray, b: np.ndarray, min_overlap: int) -> Tuple[float, int]:
+    """
+    Aligns two decoded fingerprints and returns the share of their bits that match where they overlap, together with
+    the offset of the second one in values. Versions of the same recording match on about 90% of the bits, unrelated
+    recordings on about 50%. The alignment is the most common offset of the values both fingerprints contain.
+    """
+    keys_a, positions_a = np.unique(a >> (32 - VibesterConfig.duplicate_key_bits), return_index=True)
+    keys_b, positions_b = np.unique(b >> (32 - VibesterConfig.duplicate_key_bits), return_index=True)
+    _, index_a, index_b = np.intersect1d(keys_a, keys_b, assume_unique=True, return_indices=True)
+    if len(index_a) == 0:
+        return 0.0, 0
+    offsets = positions_a[index_a].astype(np.int64) - positions_b[index_b]
+    offset = int(np.bincount(offsets - offsets.min()).argmax() + offsets.min())
+
+    a, b = (a[offset:], b) if offset >= 0 else (a, b[-offset:])
+    overlap = min(len(a), len(b))
+    if overlap < min_overlap:
+        return 0.0, offset
+    differing = np.unpackbits(np.bitwise_xor(a[:overlap], b[:overlap]).view(np.uint8)).sum()
+    return 1.0 - differing / (32 * overlap), offset
+
+
+class DuplicateIndex:
+    """
+    Locality-sensitive hashing index of Chromaprint fingerprints that finds near-duplicate recordings, e.g. the album
+    and the single version of a track or a remaster, without comparing every pair of files.
+    The highest bits of the values of a fingerprint form its set of keys, which barely depends on the encoding or the
+    alignment of the audio. The MinHash signature of the key set is split into bands and files that share any band
+    are the candidate pairs, so files whose keys overlap a lot almost surely become candidates and unrelated files
+    rarely do. The candidates are verified by comparing the fingerprints bit by bit.
+    """
+    def __init__(self, num_perm: int, bands: int, seed: int = 0):
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.prime = (1 << 31) - 1
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, self.prime, size=(num_perm, 1), dtype=np.int64)
+        self.b = rng.integers(0, self.prime, size=(num_perm, 1), dtype=np.int64)
+        self.fingerprints: Dict[str, np.ndarray] = dict()
+        self.buckets: Dict[Tuple[int, bytes], List[str]] = defaultdict(list)
+
+    def add(self, key: str, fingerprint: np.ndarray) -> None:
+        """
+        Adds the decoded fingerprint of a file to the index.
+        """
+        keys = np.unique(fingerprint >> (32 - VibesterConfig.duplicate_key_bits)).astype(np.int64)
+        if len(keys) == 0:
+            return None
+        signature = ((self.a * keys + self.b) % self.prime).min(axis=1)
+        self.fingerprints[key] = fingerprint
+        for band in range(self.bands):
+            self.buckets[(band, signature[band * self.rows:(band + 1) * self.rows].tobytes())].append(key)
+
+    def candidates(self) -> Set[Tuple[str, str]]:
+        """
+        Returns the pairs of files that share a band of their signatures.
+        """
+        pairs = set()
+        for keys in self.buckets.values():
+            pairs.update(itertools.combinations(sorted(keys), 2))
+        return pairs
+
+    def find_duplicates(self, min_similarity: float, min_overlap: int) -> List[List[Tuple[str, float]]]:
+        """
+        Returns the groups of duplicates, largest first. Each group lists its files with their similarity to the
+        first file of the group. Files are grouped if they are duplicates of any file of the group.
+        """
+        parents = {key: key for key in self.fingerprints}
+
+        def find(key: str) -> str:
+            while parents[key] != key:
+                parents[key] = parents[parents[key]]
+                key = parents[key]
+            return key
+
+        similarities = dict()
+        for a, b in self.candidates():
+            fingerprint_a, fingerprint_b = self.fingerprints[a], self.fingerprints[b]
+            similarity, _ = compare_fingerprints(a=fingerprint_a, b=fingerprint_b, min_overlap=min_overlap)
+            if similarity >= min_similarity:
+                similarities[(a, b)] = similarity
+                parents[find(b)] = find(a)
+
+        groups = defaultdict(list)
+        for key in sorted(self.fingerprints):
+            groups[find(key)].append(key)
+
+        result = []
+        for keys in groups.values():
+            if len(keys) < 2:
+                continue
+            first = keys[0]
+            result.append([(first, 1.0)] + [
+                (key, float(similarities.get((first, key)) or compare_fingerprints(
+                    a=self.fingerprints[first], b=self.fingerprints[key], min_overlap=min_overlap
+                )[0]))
+                for key in keys[1:]
+            ])
+        return sorted(result, key=len, reverse=True)
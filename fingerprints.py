@@ -0,0 +1,82 @@
+import os
+import time
+import sqlite3
+import acoustid
+import threading
+from utils.sqlite import connect
+from config import VibesterConfig
+from typing import Optional, Tuple
+from library import library_index, calculate_file_hash
+
+
+class FingerprintStore:
+    """
+    Store of the Chromaprint fingerprints of the music files, kept in SQLite and keyed by the content hash of the file.
+    Fingerprinting decodes the whole file, so it is done once per file content. Identifying a file again, retrying it
+    with another provider or rebuilding the DB reuses the stored fingerprint, also if the file was renamed or moved.
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.local = threading.local()  # One connection per thread
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread to the store and creates the table on the first use.
+        """
+        if getattr(self.local, "pid", None) != os.getpid():  # Forked worker processes must not reuse the connection
+            connection = connect(self.filepath)
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS fingerprints ("
+                    "content_hash TEXT PRIMARY KEY, duration REAL NOT NULL, fingerprint TEXT NOT NULL, "
+                    "created REAL NOT NULL)"
+                )
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return self.local.connection
+
+    def get(self, content_hash: str) -> Optional[Tuple[float, str]]:
+        """
+        Returns the duration and the fingerprint stored for a file content, if there are any.
+        """
+        row = self._connect().execute(
+            "SELECT duration, fingerprint FROM fingerprints WHERE content_hash = ?", (content_hash,)
+        ).fetchone()
+        return (row["duration"], row["fingerprint"]) if row is not None else None
+
+    def put(self, content_hash: str, duration: float, fingerprint: str) -> None:
+        """
+        Stores the duration and the fingerprint of a file content.
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO fingerprints (content_hash, duration, fingerprint, created) "
+                "VALUES (?, ?, ?, ?)",
+                (content_hash, duration, fingerprint, time.time()),
+            )
+
+    def fingerprint_file(self, filepath: str) -> Tuple[float, str]:
+        """
+        Returns the duration and the fingerprint of a music file, calculating them only if the content of the file
+        has not been fingerprinted yet. Files in the music folder are hashed through the library index, which only
+        hashes a file again if it changed.
+        """
+        relpath = os.path.relpath(os.path.abspath(filepath), os.path.abspath(VibesterConfig.path_music))
+        if relpath.startswith(".."):  # Not in the music folder, e.g. an upload being processed
+            content_hash = calculate_file_hash(filepath=filepath)
+        else:
+            content_hash = library_index.get_content_hash(relpath=relpath.replace("\\", "/"))
+
+        if content_hash is not None:
+            stored = self.get(content_hash=content_hash)
+            if stored is not None:
+                return stored
+
+        duration, fingerprint = acoustid.fingerprint_file(filepath)  # Decodes the audio with Chromaprint
+        fingerprint = fingerprint.decode("ascii") if isinstance(fingerprint, bytes) else fingerprint
+        if content_hash is not None:
+            self.put(content_hash=content_hash, duration=duration, fingerprint=fingerprint)
+        return duration, fingerprint
+
+
+fingerprint_store = FingerprintStore(filepath=VibesterConfig.path_fingerprints)
@@ -1,7 +1,6 @@
 import os
 import tempfile
 import pandas as pd
-from typing import List
 from pathlib import Path
 from PyPDF2 import PdfMerger
 from config import VibesterConfig
@@ -9,6 +8,7 @@ from generator.table import Table
 from generator.track import Track
 from svglib.svglib import svg2rlg
 from reportlab.graphics import renderPDF
+from typing import List, Optional, Callable
 
 
 def get_tracks(df: pd.DataFrame) -> List[Track]:
@@ -67,46 +67,53 @@ def get_svg_files(tables: List[Table]) -> List[str]:
     return svg_files
 
 
-def write_to_pdf(svg_files: List[str], filename: str) -> None:
+def write_to_pdf(svg_files: List[str], filename: str, progress: Optional[Callable[[float], None]] = None) -> None:
     """
     Takes a list of SVG files and writes them into a single PDF file.
+    The progress function is called with the ratio of the pages rendered so far.
     """
     filepath = os.path.join(VibesterConfig.path_output, filename)
     temp_pdfs = []
 
-    for svg_content in svg_files:
-        # Create a temporary SVG file for the content
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".svg") as temp_svg:
-            temp_svg.write(svg_content.encode("utf-8"))  # Write SVG content to temp file
-            temp_svg_path = temp_svg.name
+    try:
+        for i, svg_content in enumerate(svg_files):
+            # Create a temporary SVG file for the content
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".svg") as temp_svg:
+                temp_svg.write(svg_content.encode("utf-8"))  # Write SVG content to temp file
+                temp_svg_path = temp_svg.name
 
-        # Convert the temporary SVG file to a ReportLab drawing
-        drawing = svg2rlg(temp_svg_path)
-        temp_pdf = temp_svg_path.replace(".svg", ".pdf")  # Temporary PDF file name
+            # Convert the temporary SVG file to a ReportLab drawing
+            drawing = svg2rlg(temp_svg_path)
+            temp_pdf = temp_svg_path.replace(".svg", ".pdf")  # Temporary PDF file name
 
-        # Write the drawing to a temporary PDF file
-        with open(temp_pdf, "wb") as pdf_file:
-            renderPDF.drawToFile(drawing, pdf_file)
-        temp_pdfs.append(temp_pdf)
+            # Write the drawing to a temporary PDF file
+            with open(temp_pdf, "wb") as pdf_file:
+                renderPDF.drawToFile(drawing, pdf_file)
+            temp_pdfs.append(temp_pdf)
 
-        # Clean up the temporary SVG file
-        Path(temp_svg_path).unlink()
+            # Clean up the temporary SVG file
+            Path(temp_svg_path).unlink()
 
-    # Merge all PDFs into one
-    merger = PdfMerger()
-    for temp_pdf in temp_pdfs:
-        merger.append(temp_pdf)
-    merger.write(filepath)
-    merger.close()
+            if progress is not None:
+                progress((i + 1) / len(svg_files))
 
-    # Cleanup temporary PDF files
-    for temp_pdf in temp_pdfs:
-        Path(temp_pdf).unlink()
+        # Merge all PDFs into one
+        merger = PdfMerger()
+        for temp_pdf in temp_pdfs:
+            merger.append(temp_pdf)
+        merger.write(filepath)
+        merger.close()
 
+    finally:
+        # Cleanup temporary PDF files, also if the rendering was interrupted
+        for temp_pdf in temp_pdfs:
+            Path(temp_pdf).unlink(missing_ok=True)
 
-def generate(df: pd.DataFrame, filename: str) -> None:
+
+def generate(df: pd.DataFrame, filename: str, progress: Optional[Callable[[float], None]] = None) -> None:
     """
     Takes a pandas DataFrame and renders a pdf file from it.
+    The progress function is called with the ratio of the pages rendered so far.
     """
     # Append pdf to
     if not filename.endswith(".pdf"):
@@ -125,7 +132,7 @@ def generate(df: pd.DataFrame, filename: str) -> None:
     svg_files = get_svg_files(tables=tables)
 
     # Render the SVG files into a single pdf
-    write_to_pdf(svg_files=svg_files, filename=filename)
+    write_to_pdf(svg_files=svg_files, filename=filename, progress=progress)
 
     print(f"Successfully output to: {os.path.join(VibesterConfig.path_output, filename)}")
 
@@ -28,7 +28,7 @@ login_manager.init_app(server)
 login_manager.login_view = "login"
 
 # Dash app setup
-app = dash.Dash(__name__, server=server)
+app = dash.Dash(__name__, server=server, assets_ignore=r"\.worker\.js$")  # Web Workers are loaded on demand
 app.config.suppress_callback_exceptions = True
 
 # Initialize the user manager
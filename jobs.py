@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import multiprocessing
+from utils.sqlite import connect
+from config import VibesterConfig
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Any, Callable, List, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, Future
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job when its cancellation was requested.
+    """
+
+
+class JobStore:
+    """
+    Store of the background jobs in SQLite, shared by the server processes and the worker processes running the jobs.
+    A job goes through the statuses queued, running and then done, failed or cancelled. The progress of a job is
+    a number between 0 and 1 with a message, and the result of a finished job is stored as JSON. A job can also emit
+    partial results while it runs, which the pages read in the order they were emitted.
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.local = threading.local()  # One connection per thread
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread to the store and creates the table on the first use.
+        """
+        if getattr(self.local, "pid", None) != os.getpid():  # Forked worker processes must not reuse the connection
+            connection = connect(self.filepath)
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "id TEXT PRIMARY KEY, kind TEXT NOT NULL, user TEXT, status TEXT NOT NULL, "
+                    "progress REAL NOT NULL DEFAULT 0, message TEXT, result TEXT, "
+                    "cancel INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, updated REAL NOT NULL)"
+                )
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS job_items ("
+                    "job_id TEXT NOT NULL, seq INTEGER NOT NULL, item TEXT NOT NULL, PRIMARY KEY (job_id, seq))"
+                )
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return self.local.connection
+
+    def _update(self, job_id: str, **values: Any) -> None:
+        """
+        Updates columns of a job.
+        """
+        columns = ", ".join(f"{column} = ?" for column in values)
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                f"UPDATE jobs SET {columns}, updated = ? WHERE id = ?", (*values.values(), time.time(), job_id)
+            )
+
+    def create(self, kind: str, user: Optional[str]) -> str:
+        """
+        Registers a new job and returns its ID.
+        """
+        job_id = uuid.uuid4().hex
+        connection = self._connect()
+        with connection:
+            connection.execute(  # Partial results of old jobs are no longer read
+                "DELETE FROM job_items WHERE job_id IN (SELECT id FROM jobs WHERE updated < ? "
+                "AND status NOT IN ('queued', 'running'))",
+                (time.time() - VibesterConfig.job_item_retention,),
+            )
+            connection.execute(
+                "INSERT INTO jobs (id, kind, user, status, message, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, user, "queued", "Waiting for a worker", time.time(), time.time()),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the status, progress, message and result of a job.
+        """
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def set_progress(self, job_id: str, progress: float, message: Optional[str]) -> bool:
+        """
+        Stores the progress of a running job. Returns whether the cancellation of the job was requested.
+        """
+        self._update(job_id, status="running", progress=progress, message=message)
+        row = self._connect().execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row["cancel"])
+
+    def finish(self, job_id: str, status: str, message: str, result: Any = None) -> None:
+        """
+        Stores the final status of a job and its result.
+        """
+        values = {"status": status, "message": message, "result": json.dumps(result)}
+        if status == "done":
+            values["progress"] = 1.0
+        self._update(job_id, **values)
+
+    def add_items(self, job_id: str, items: List[Any]) -> None:
+        """
+        Stores partial results of a running job. Only the job itself adds items, so the numbering has no gaps.
+        """
+        connection = self._connect()
+        with connection:
+            row = connection.execute("SELECT MAX(seq) AS seq FROM job_items WHERE job_id = ?", (job_id,)).fetchone()
+            seq = row["seq"] or 0
+            connection.executemany(
+                "INSERT INTO job_items (job_id, seq, item) VALUES (?, ?, ?)",
+                [(job_id, seq + i + 1, json.dumps(item)) for i, item in enumerate(items)],
+            )
+
+    def get_items(self, job_id: str, after: int = 0) -> List[Tuple[int, Any]]:
+        """
+        Returns the (number, item) pairs of the partial results of a job that were emitted after the given number.
+        """
+        rows = self._connect().execute(
+            "SELECT seq, item FROM job_items WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after)
+        ).fetchall()
+        return [(row["seq"], json.loads(row["item"])) for row in rows]
+
+    def cancel(self, job_id: str) -> None:
+        """
+        Requests the cancellation of a job. A running job stops at its next progress report.
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "UPDATE jobs SET cancel = 1, updated = ? WHERE id = ? AND status IN ('queued', 'running')",
+                (time.time(), job_id),
+            )
+
+
+class JobContext:
+    """
+    Handle a job function receives to report its progress. Reporting is also where a cancelled job stops.
+    """
+    def __init__(self, store: JobStore, job_id: str, min_interval: float = 0.25):
+        self.store = store
+        self.job_id = job_id
+        self.min_interval = min_interval  # Seconds between two writes of the progress
+        self.reported = 0.0
+        self.message = None
+
+    def update(self, progress: float, message: Optional[str] = None) -> None:
+        """
+        Reports the progress (0-1) of the job. Raises JobCancelled if the job was cancelled.
+        """
+        message = message or self.message
+        if message == self.message and time.monotonic() - self.reported < self.min_interval:
+            return None
+        self.reported, self.message = time.monotonic(), message
+        if self.store.set_progress(job_id=self.job_id, progress=progress, message=message):
+            raise JobCancelled()
+
+    def emit(self, items: List[Any]) -> None:
+        """
+        Publishes partial results of the job, e.g. rows of a table, before the job is finished.
+        """
+        if items:
+            self.store.add_items(job_id=self.job_id, items=items)
+
+
+def run_job(job_id: str, f: Callable, *args: Any) -> None:
+    """
+    Runs a job function in a worker process and stores its outcome. The function is called with a JobContext and
+    the arguments of the job, and its return value is stored as the result of the job.
+    """
+    context = JobContext(store=job_store, job_id=job_id)
+    try:
+        if job_store.get(job_id=job_id)["cancel"]:
+            raise JobCancelled()
+        context.update(progress=0.0, message="Started")
+        result = f(context, *args)
+        job_store.finish(job_id=job_id, status="done", message="Done", result=result)
+    except JobCancelled:
+        job_store.finish(job_id=job_id, status="cancelled", message="Cancelled")
+    except Exception as e:
+        print(f"Error in job {job_id}\n{e}")
+        job_store.finish(job_id=job_id, status="failed", message=f"{e}")
+
+
+class JobRunner:
+    """
+    Runs the background jobs, e.g. the rendering of a deck, in worker processes, so they neither block the callbacks
+    nor compete with them for the interpreter lock. Jobs beyond max_workers wait in the queue of the pool.
+    Jobs that mostly wait on the network can run in threads of the server process instead, with a ThreadPoolExecutor.
+    """
+    def __init__(self, store: JobStore, max_workers: int, executor_class: type = ProcessPoolExecutor):
+        self.store = store
+        self.max_workers = max_workers
+        self.executor_class = executor_class
+        self.lock = threading.Lock()
+        self.executor: Optional[Executor] = None  # Started on the first job
+        self.active: Dict[str, str] = dict()  # Kinds of the jobs submitted by this server process that are not finished
+
+    def _create_executor(self) -> Executor:
+        """
+        Starts the pool of workers. Worker processes are started by a fork server rather than forked from the server
+        process, whose threads may hold locks at the time of the fork that would never be released in the worker.
+        """
+        if issubclass(self.executor_class, ProcessPoolExecutor):
+            context = multiprocessing.get_context("forkserver")
+            return self.executor_class(max_workers=self.max_workers, mp_context=context)
+        return self.executor_class(max_workers=self.max_workers)
+
+    def submit(self, kind: str, user: Optional[str], f: Callable, *args: Any, unique: bool = False) -> str:
+        """
+        Queues a job and returns its ID. The function must be importable by the worker processes. A unique job is not
+        queued if a job of the same kind is already active in this server process, the ID of that job is returned.
+        """
+        with self.lock:
+            if unique:
+                for job_id, active_kind in self.active.items():
+                    if active_kind == kind:
+                        return job_id
+            job_id = self.store.create(kind=kind, user=user)
+            if self.executor is None:
+                self.executor = self._create_executor()
+            try:
+                future = self.executor.submit(run_job, job_id, f, *args)
+            except BrokenProcessPool:
+                self.executor = self._create_executor()  # A worker died, start a new pool
+                future = self.executor.submit(run_job, job_id, f, *args)
+            self.active[job_id] = kind
+        future.add_done_callback(lambda done: self._check_crash(job_id=job_id, future=done))
+        return job_id
+
+    def is_active(self, job_id: str) -> bool:
+        """
+        Returns whether a job submitted by this server process is queued or running. Jobs of a server process that was
+        stopped are never active, even if they could not record their end, which is how the generate page finds them.
+        """
+        with self.lock:
+            return job_id in self.active
+
+    def _check_crash(self, job_id: str, future: Future) -> None:
+        """
+        Marks a job as failed if its worker process died, since the job could not record that itself.
+        """
+        with self.lock:
+            self.active.pop(job_id, None)
+        if not future.cancelled() and future.exception() is not None:
+            self.store.finish(job_id=job_id, status="failed", message=f"The worker stopped: {future.exception()}")
+
+
+job_store = JobStore(filepath=VibesterConfig.path_jobs)
+job_runner = JobRunner(store=job_store, max_workers=VibesterConfig.job_workers)
+duplicate_runner = JobRunner(store=job_store, max_workers=VibesterConfig.duplicate_workers)
+scan_runner = JobRunner(
+    store=job_store,
+    max_workers=VibesterConfig.library_scan_workers,
+    executor_class=ThreadPoolExecutor,
+)
@@ -0,0 +1,215 @@
+import os
+import pickle
+import hashlib
+import tempfile
+import threading
+from config import VibesterConfig
+from typing import Optional, Dict, List, Tuple
+
+
+def calculate_file_hash(filepath: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Calculates the SHA-1 hash of the content of a file.
+    """
+    sha1_hash = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1_hash.update(chunk)
+    return sha1_hash.hexdigest()
+
+
+class LibraryIndex:
+    """
+    Index of the music library that maps the filename of every music file to its path relative to the music folder.
+    The index is persisted next to the DB and refreshed incrementally: only the folders whose modification time
+    changed since the last refresh are listed again, so resolving a filename never walks the whole tree.
+    """
+    def __init__(self, filepath: str, root_dir: str):
+        """
+        Initializes the index with the file it is persisted to and the root of the music folder.
+        The persisted index is loaded lazily on first use.
+        """
+        self.filepath = filepath
+        self.root_dir = root_dir
+        self.lock = threading.RLock()
+        self.files: Optional[Dict[str, str]] = None  # filename -> relative path
+        self.dirs: Dict[str, Tuple[float, List[str], List[str]]] = dict()  # relative dir -> (mtime, subdirs, files)
+        self.hashes: Dict[str, Tuple[int, float, str]] = dict()  # relative path -> (size, mtime, content hash)
+        self.dirty = False  # New content hashes that are not persisted yet
+
+    def _load(self) -> None:
+        """
+        Loads the index from the Pickle file or builds it if the file doesn't exist.
+        """
+        if os.path.exists(self.filepath):
+            try:
+                with open(self.filepath, "rb") as f:
+                    state = pickle.load(f)
+                self.files, self.dirs, self.hashes = state["files"], state["dirs"], state.get("hashes", dict())
+                return
+            except Exception as e:
+                print(f"Could not load {self.filepath}, rebuilding the library index\n{e}")
+        self.files, self.dirs, self.hashes = dict(), dict(), dict()
+        self.refresh()
+
+    def _save(self) -> None:
+        """
+        Saves the index to the Pickle file. The file is replaced atomically so readers never see a partial index.
+        Every save writes its own temporary file, as the index is saved by the server and the job workers alike.
+        """
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.filepath), delete=False) as f:
+            pickle.dump({"files": self.files, "dirs": self.dirs, "hashes": self.hashes}, f)
+        os.replace(f.name, self.filepath)
+        self.dirty = False
+
+    def _scan_dir(self, reldir: str) -> bool:
+        """
+        Refreshes a single folder of the library and recurses into its subfolders.
+        Returns whether anything changed in the folder or below it.
+        """
+        absdir = os.path.join(self.root_dir, reldir)
+        try:
+            mtime = os.stat(absdir).st_mtime
+        except OSError:
+            return self._drop_dir(reldir=reldir)
+
+        changed = False
+        cached = self.dirs.get(reldir)
+        if cached is None or cached[0] != mtime:  # Entries were added, removed or renamed in this folder
+            subdirs, filenames = [], []
+            for entry in os.scandir(absdir):
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    filenames.append(entry.name)
+
+            old_subdirs, old_filenames = (cached[1], cached[2]) if cached else ([], [])
+            for subdir in set(old_subdirs) - set(subdirs):
+                self._drop_dir(reldir=self._join(reldir, subdir))
+            for filename in set(old_filenames) - set(filenames):
+                self._remove_file(reldir=reldir, filename=filename)
+            for filename in filenames:
+                self.files.setdefault(filename, self._join(reldir, filename))  # The first path found is kept
+
+            self.dirs[reldir] = (mtime, subdirs, filenames)
+            changed = True
+
+        for subdir in self.dirs[reldir][1]:
+            changed = self._scan_dir(reldir=self._join(reldir, subdir)) or changed
+        return changed
+
+    def _drop_dir(self, reldir: str) -> bool:
+        """
+        Removes a folder that no longer exists and everything below it from the index.
+        """
+        cached = self.dirs.pop(reldir, None)
+        if cached is None:
+            return False
+        for subdir in cached[1]:
+            self._drop_dir(reldir=self._join(reldir, subdir))
+        for filename in cached[2]:
+            self._remove_file(reldir=reldir, filename=filename)
+        return True
+
+    def _remove_file(self, reldir: str, filename: str) -> None:
+        """
+        Removes a file from the index. If a file with the same name is in another folder, that one is indexed instead.
+        """
+        self.hashes.pop(self._join(reldir, filename), None)
+        if self.files.get(filename) != self._join(reldir, filename):
+            return
+        del self.files[filename]
+        for other_dir, (_, _, filenames) in self.dirs.items():
+            if other_dir != reldir and filename in filenames:
+                self.files[filename] = self._join(other_dir, filename)
+                return
+
+    @staticmethod
+    def _join(reldir: str, name: str) -> str:
+        """
+        Joins a relative folder and a name with forward slashes, which is how the index stores paths.
+        """
+        return f"{reldir}/{name}" if reldir else name
+
+    def refresh(self) -> None:
+        """
+        Brings the index up to date with the music folder and persists it if anything changed.
+        """
+        with self.lock:
+            if self.files is None:
+                self._load()
+                return
+            if self._scan_dir(reldir="") or self.dirty:
+                self._save()
+
+    def save(self) -> None:
+        """
+        Persists the content hashes calculated since the index was last saved.
+        """
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def get_path(self, filename: str) -> Optional[str]:
+        """
+        Returns the path of a music file relative to the music folder.
+        The index is refreshed if the file is unknown or was moved since it was indexed.
+        """
+        with self.lock:
+            if self.files is None:
+                self._load()
+            relpath = self.files.get(filename)
+            if relpath is None or not os.path.isfile(os.path.join(self.root_dir, relpath)):
+                self.refresh()
+                relpath = self.files.get(filename)
+            return relpath
+
+    def find(self, filename: str, relpath: Optional[str] = None) -> Optional[str]:
+        """
+        Returns the path of a music file including the music folder, or None if it is not in the library.
+        The relative path stored in the DB is used if it is given and still points to the file.
+        """
+        if not isinstance(relpath, str) or not os.path.isfile(os.path.join(self.root_dir, relpath)):
+            relpath = self.get_path(filename=filename)
+        if relpath is None:
+            return None
+        return f"{self.root_dir}/{relpath}"
+
+    def get_content_hash(self, relpath: str, calculate: bool = True) -> Optional[str]:
+        """
+        Returns the hash of the content of a music file given by its relative path. The hash is only recalculated if
+        the size or the modification time of the file changed. Unlike the path, it identifies a file even if it is
+        renamed or moved. With calculate=False only a hash that is still valid is returned, which never reads the file.
+        """
+        filepath = os.path.join(self.root_dir, relpath)
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+
+        with self.lock:
+            if self.files is None:
+                self._load()
+            cached = self.hashes.get(relpath)
+            if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+                return cached[2]
+            if not calculate:
+                return None
+
+        content_hash = calculate_file_hash(filepath=filepath)  # Hashed outside the lock, it reads the whole file
+        with self.lock:
+            self.hashes[relpath] = (stat.st_size, stat.st_mtime, content_hash)
+            self.dirty = True  # Persisted with the next refresh or save
+        return content_hash
+
+    def items(self) -> List[Tuple[str, str]]:
+        """
+        Returns the (filename, relative path) pairs of the whole library after refreshing the index.
+        """
+        with self.lock:
+            self.refresh()
+            return list(self.files.items())
+
+
+library_index = LibraryIndex(filepath=VibesterConfig.path_library, root_dir=VibesterConfig.path_music)
@@ -1,16 +1,169 @@
 import os
+import math
+import uuid
+import sqlite3
+import threading
+import numpy as np
 import pandas as pd
 from decorators import robust
+from utils.sqlite import connect
 from config import VibesterConfig
+from typing import Optional, Dict, List, Any
+
+catalog_columns = ["filename", "path", "directory", "artist", "title", "year", "genre", "saved", "hash"]
+
+
+def to_value(value: Any) -> Any:
+    """
+    Converts a value of a row of the music table to a value SQLite can store, with None instead of NaN.
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is pd.NA or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
+
+class Catalog:
+    """
+    Catalog of the music in SQLite: the tags of every music file, whether its card was generated and the hash printed
+    on the card. Card lookups are indexed queries, so they don't depend on the size of the catalog, and saving a deck
+    writes only the rows that changed, in one transaction, so decks generated by different users at the same time
+    don't overwrite each other. The version of the catalog changes whenever its rows change.
+    The catalog of older versions, a pickled DataFrame, is migrated into the database once, on the first use.
+    """
+    def __init__(self, filepath: str, legacy_filepath: str):
+        self.filepath = filepath
+        self.legacy_filepath = legacy_filepath
+        self.local = threading.local()  # One connection per thread
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread to the catalog and creates the tables on the first use.
+        """
+        if getattr(self.local, "pid", None) != os.getpid():  # Forked worker processes must not reuse the connection
+            connection = connect(self.filepath)
+            with connection:
+                connection.execute(  # Tags are stored as they are, e.g. years edited as text
+                    "CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, filename TEXT NOT NULL, path TEXT, "
+                    "directory TEXT, artist, title, year, genre, saved INTEGER, hash TEXT)"
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS tracks_hash ON tracks (hash)")
+                connection.execute("CREATE INDEX IF NOT EXISTS tracks_filename ON tracks (filename)")
+                connection.execute("CREATE INDEX IF NOT EXISTS tracks_directory ON tracks (directory)")
+                connection.execute("CREATE TABLE IF NOT EXISTS catalog_meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._migrate(connection=connection)
+            self.local.connection, self.local.pid = connection, os.getpid()
+        return self.local.connection
+
+    def _migrate(self, connection: sqlite3.Connection) -> None:
+        """
+        Copies the rows of the pickled catalog into the database if it was not done yet. The pickle is kept as it is.
+        """
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")  # Only one process migrates
+            if connection.execute("SELECT 1 FROM catalog_meta WHERE key = 'migrated'").fetchone() is not None:
+                return None
+            count = 0
+            if os.path.exists(self.legacy_filepath):
+                df = pd.read_pickle(self.legacy_filepath)
+                records = [row for row in df.to_dict("records") if isinstance(row.get("filename"), str)]
+                count = self._insert(connection=connection, records=records)
+                print(f"Migrated {count} rows of {self.legacy_filepath} to {self.filepath}")
+            connection.execute("INSERT INTO catalog_meta (key, value) VALUES ('migrated', ?)", (str(count),))
+            self._bump_version(connection=connection)
+
+    @staticmethod
+    def _insert(connection: sqlite3.Connection, records: List[Dict]) -> int:
+        """
+        Inserts rows into the catalog and returns their number.
+        """
+        columns, placeholders = ", ".join(catalog_columns), ", ".join("?" * len(catalog_columns))
+        connection.executemany(
+            f"INSERT INTO tracks ({columns}) VALUES ({placeholders})",
+            [[to_value(record.get(column)) for column in catalog_columns] for record in records],
+        )
+        return len(records)
+
+    @staticmethod
+    def _bump_version(connection: sqlite3.Connection) -> None:
+        """
+        Gives the catalog a new version. Random versions are never repeated, even if the database is recreated.
+        """
+        connection.execute(
+            "INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('version', ?)", (uuid.uuid4().hex[:12],)
+        )
+
+    @staticmethod
+    def _to_record(row: sqlite3.Row) -> Dict[str, Any]:
+        """
+        Converts a row of the catalog to a row of the music table.
+        """
+        record = {column: row[column] for column in catalog_columns}
+        record["saved"] = bool(record["saved"]) if record["saved"] is not None else None
+        return record
+
+    def get_tracks(self) -> List[Dict[str, Any]]:
+        """
+        Returns every row of the catalog in the order they were added.
+        """
+        rows = self._connect().execute(f"SELECT {', '.join(catalog_columns)} FROM tracks ORDER BY id").fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def get_track(self, card_hash: str) -> Optional[Dict[str, Optional[str]]]:
+        """
+        Returns the filename and the relative path of the track belonging to a card hash if there is one. If several
+        rows have the hash, the first one is used.
+        """
+        row = self._connect().execute(
+            "SELECT filename, path FROM tracks WHERE hash = ? ORDER BY id LIMIT 1", (card_hash,)
+        ).fetchone()
+        return {"filename": row["filename"], "path": row["path"]} if row is not None else None
+
+    def get_version(self) -> str:
+        """
+        Returns the version token of the catalog. It changes whenever the rows of the catalog change.
+        """
+        row = self._connect().execute("SELECT value FROM catalog_meta WHERE key = 'version'").fetchone()
+        return row["value"] if row is not None else ""
+
+    def save_tracks(self, records: List[Dict[str, Any]]) -> int:
+        """
+        Saves rows of the music table, matched to the catalog by filename: rows of files that are not in the catalog
+        are added, rows that differ from the first row of their file in the catalog replace it and rows that did not
+        change are not written. Returns the number of rows written.
+        """
+        connection = self._connect()
+        assignments = ", ".join(f"{column} = ?" for column in catalog_columns)
+        changed = 0
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")  # Concurrent saves of the same files are applied one after the other
+            for record in records:
+                values = [to_value(record.get(column)) for column in catalog_columns]
+                if not isinstance(values[0], str):
+                    continue
+                row = connection.execute(
+                    f"SELECT id, {', '.join(catalog_columns)} FROM tracks WHERE filename = ? ORDER BY id LIMIT 1",
+                    (values[0],),
+                ).fetchone()
+                if row is None:
+                    self._insert(connection=connection, records=[dict(zip(catalog_columns, values))])
+                elif [row[column] for column in catalog_columns] != values:
+                    connection.execute(f"UPDATE tracks SET {assignments} WHERE id = ?", (*values, row["id"]))
+                else:
+                    continue
+                changed += 1
+            if changed:
+                self._bump_version(connection=connection)
+        return changed
+
+
+catalog = Catalog(filepath=VibesterConfig.path_db, legacy_filepath=VibesterConfig.path_db_legacy)
 
 
 @robust
 def load_db() -> pd.DataFrame:
     """
-    Loads the musical data from the local file system.
+    Loads the musical data from the catalog.
     """
-    if not os.path.exists(VibesterConfig.path_db):
-        df = pd.DataFrame(columns=VibesterConfig.generate_table_cols)
-        df.to_pickle(VibesterConfig.path_db)
-        print(f"Created {VibesterConfig.path_db}")
-    return pd.read_pickle(VibesterConfig.path_db)
+    return pd.DataFrame(catalog.get_tracks(), columns=catalog_columns, dtype=object)
@@ -0,0 +1,88 @@
+import os
+import time
+import pickle
+import tempfile
+import threading
+from config import VibesterConfig
+from typing import Optional, Dict
+
+
+class ScanManifest:
+    """
+    Manifest of the identification results of the music files, so a file is fingerprinted and looked up only once.
+    Results are keyed by the content hash of the file, which the library index keeps up to date by the relative path,
+    size and modification time of the file. Unchanged files are never reprocessed, and renamed or moved files are
+    recognised by their content. Failed identifications are recorded too and are only retried after failure_ttl.
+    """
+    def __init__(self, filepath: str, failure_ttl: float):
+        """
+        Initializes the manifest with the file it is persisted to. The persisted manifest is loaded lazily.
+        """
+        self.filepath = filepath
+        self.failure_ttl = failure_ttl
+        self.lock = threading.Lock()
+        self.entries: Optional[Dict[str, Dict]] = None  # content hash -> {"path", "metadata", "identified", "time"}
+        self.dirty = False
+
+    def _load(self) -> None:
+        """
+        Loads the manifest from the Pickle file if it exists. The lock must be held.
+        """
+        self.entries = dict()
+        if os.path.exists(self.filepath):
+            try:
+                with open(self.filepath, "rb") as f:
+                    self.entries = pickle.load(f)
+            except Exception as e:
+                print(f"Could not load {self.filepath}, starting with an empty scan manifest\n{e}")
+
+    def get(self, content_hash: Optional[str]) -> Optional[Dict[str, str]]:
+        """
+        Returns the recorded metadata of a file, an empty dict if it could not be identified, or None if the file has
+        to be identified (again).
+        """
+        if content_hash is None:
+            return None
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            entry = self.entries.get(content_hash)
+            if entry is None:
+                return None
+            if not entry["identified"] and time.time() - entry["time"] > self.failure_ttl:
+                return None  # The lookup services may know the track by now
+            return dict(entry["metadata"])
+
+    def put(self, content_hash: Optional[str], relpath: str, metadata: Dict[str, str]) -> None:
+        """
+        Records the identification result of a file. An empty metadata dict records a failure.
+        """
+        if content_hash is None:
+            return None
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            self.entries[content_hash] = {
+                "path": relpath,
+                "metadata": dict(metadata),
+                "identified": bool(metadata),
+                "time": time.time(),
+            }
+            self.dirty = True
+
+    def save(self) -> None:
+        """
+        Persists the manifest if anything was recorded since it was last saved. The file is replaced atomically,
+        through a temporary file of its own, as the server and the job workers save the manifest at the same time.
+        """
+        with self.lock:
+            if not self.dirty:
+                return None
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.filepath), delete=False) as f:
+                pickle.dump(self.entries, f)
+            os.replace(f.name, self.filepath)
+            self.dirty = False
+
+
+scan_manifest = ScanManifest(filepath=VibesterConfig.path_manifest, failure_ttl=VibesterConfig.manifest_failure_ttl)
@@ -1,140 +1,237 @@
 import os
-import re
-import datetime
-import pandas as pd
-from loader import load_db
 from config import VibesterConfig
-from typing import Dict, List, Any
-from generator.generate import generate
-from dash import Input, Output, State, dcc, callback, ctx, no_update
-from pages.generate.utils import is_music_file, calculate_hash, get_metadata, write_id3_tags_batch
+from flask_login import current_user
+from typing import Dict, List, Any, Optional
+from pages.generate.table import music_table
+from jobs import job_store, job_runner, scan_runner, duplicate_runner
+from pages.generate.utils import scan_library, find_duplicates, generate_deck
+from dash import Input, Output, State, dcc, callback, clientside_callback, no_update
 
 
 def register_callbacks() -> None:
     @callback(
-        Output({"name": "music_table", "type": "table", "page": "index"}, "rowData"),
+        Output({"name": "table_version", "type": "store", "page": "generate"}, "data"),
+        Output({"name": "scan_store", "type": "store", "page": "generate"}, "data"),
+        Output({"name": "scan_poll", "type": "interval", "page": "generate"}, "disabled"),
         Input({"name": "url", "type": "location", "page": "index"}, "pathname"),
-        Input({"name": "music_store", "type": "store", "page": "generate"}, "data"),
     )
-    def load_music_table(pathname: str, row_data: List[Dict]) -> List[Dict]:
-        """
-        Loads music from the local storage and correlates it with music stored in the local db. Only records that are
-        present in both of the databases are kept. If the generate button is pressed the records in this table will
-        be generated a QR code from.
-        """
-        if ctx.triggered[0]["prop_id"] == ".":
-            # Handle the behavior when triggered by the URL
-            if pathname != "/generate":
-                return no_update
-
-            df_db = load_db()
-            result = pd.DataFrame()
-
-            for root, _, files in os.walk(VibesterConfig.path_music):  # Traverse target folder recursively
-                for filename in files:
-                    filepath = os.path.abspath(str(os.path.join(root, filename)))
-
-                    if is_music_file(filename) and filename in df_db["filename"].values:  # Music file in database
-                        new_row = pd.DataFrame(
-                            df_db[df_db["filename"] == filename]
-                        ).drop_duplicates(keep="first", subset="filename")
-                        new_row["directory"] = str(os.path.basename(root))  # Add directory column
-
-                    elif is_music_file(filename) and filename not in df_db["filename"].values:
-                        music_metadata = get_metadata(filepath=filepath)
-                        if music_metadata is None:
-                            music_metadata = dict()
-
-                        new_row = pd.DataFrame(
-                            {
-                                "filename": [filename],
-                                "artist": [music_metadata.get("artist", None)],
-                                "title": [music_metadata.get("title", None)],
-                                "year": [music_metadata.get("year", None)],
-                                "genre": [music_metadata.get("genre", None)],
-                                "saved": [False],
-                                "hash": [None],
-                                "directory": [os.path.basename(root)],
-                            }
-                        )
-
-                    else:
-                        continue
-
-                    result = pd.concat([result, new_row], ignore_index=True)
-
-            return result.to_dict("records")
+    def load_music_table(pathname: str) -> tuple:
+        """
+        Loads music from the local storage and correlates it with music stored in the local db. If the generate button
+        is pressed the records in this table will be generated a QR code from.
+        The rows stay on the server and the table requests the ones it shows through get_rows. The files that were
+        never identified are identified by a background scan whose rows are added to the table by poll_scan. There is
+        one scan at a time, pages opened while it runs, in other tabs or by other users, follow it instead of queueing
+        another scan of the same files. Files added in the meantime are scanned on a visit after it finished.
+        """
+        if pathname != "/generate":
+            return no_update, no_update, no_update
 
+        unidentified = music_table.load()
+        if unidentified:
+            job_id = scan_runner.submit("scan", current_user.get_id(), scan_library, unidentified, unique=True)
+            scan_data = {"id": job_id, "seq": 0}  # The rows found since the last save of the scan manifest are replayed
         else:
-            # Handle behavior when the generate button updates the content of the table
-            return row_data
+            scan_data = None
+        return music_table.get_version(), scan_data, scan_data is None
+
+    @callback(
+        Output({"name": "music_table", "type": "table", "page": "index"}, "getRowsResponse"),
+        Input({"name": "music_table", "type": "table", "page": "index"}, "getRowsRequest"),
+        State({"name": "table_session", "type": "store", "page": "generate"}, "data"),
+        prevent_initial_call=True,
+    )
+    def get_rows(request: Optional[Dict], session_id: str) -> Dict:
+        """
+        Answers the request of the table for a block of rows. The rows are sorted and filtered on the server.
+        """
+        if not request:
+            return no_update
+        rows, row_count = music_table.query(
+            session_id=session_id,
+            start_row=request["startRow"],
+            end_row=request["endRow"],
+            sort_model=request.get("sortModel"),
+            filter_model=request.get("filterModel"),
+        )
+        return {"rowData": rows, "rowCount": row_count}
+
+    @callback(
+        Input({"name": "music_table", "type": "table", "page": "index"}, "cellValueChanged"),
+        prevent_initial_call=True,
+    )
+    def edit_cell(changes: Optional[List[Dict]]) -> None:
+        """
+        Stores the cells edited in the table, e.g. a corrected release year, so the deck is generated with them.
+        """
+        for change in changes or []:
+            music_table.edit(path=change["data"]["path"], column=change["colId"], value=change["newValue"])
+
+    clientside_callback(
+        """
+        function(version) {
+            // Drops the rows the table has loaded, so the ones it shows are requested again
+            if (version) {
+                dash_ag_grid.getApiAsync({"name": "music_table", "type": "table", "page": "index"})
+                    .then((api) => api.refreshInfiniteCache())
+                    .catch((err) => console.error("Could not refresh the music table:", err));
+            }
+            return "";
+        }
+        """,
+        Output({"name": "dummy", "type": "store", "page": "generate"}, "data"),
+        Input({"name": "table_version", "type": "store", "page": "generate"}, "data"),
+    )
+
+    @callback(
+        Output({"name": "table_version", "type": "store", "page": "generate"}, "data", allow_duplicate=True),
+        Output({"name": "scan_store", "type": "store", "page": "generate"}, "data", allow_duplicate=True),
+        Output({"name": "scan_poll", "type": "interval", "page": "generate"}, "disabled", allow_duplicate=True),
+        Output({"name": "scan_message", "type": "text", "page": "generate"}, "children"),
+        Input({"name": "scan_poll", "type": "interval", "page": "generate"}, "n_intervals"),
+        State({"name": "scan_store", "type": "store", "page": "generate"}, "data"),
+        prevent_initial_call=True,
+    )
+    def poll_scan(n_intervals: int, scan_data: Optional[Dict]) -> tuple:
+        """
+        Adds the rows identified by the background scan of the library since the last poll to the table and shows how
+        many of the new files are done. A scan of a server process that was stopped is marked as failed like in
+        poll_job.
+        """
+        job = job_store.get(job_id=scan_data["id"]) if scan_data else None
+        if job is not None and job["status"] in ("queued", "running") and not scan_runner.is_active(job_id=job["id"]):
+            job_store.finish(job_id=job["id"], status="failed", message="The server was stopped before the job ended")
+            job = job_store.get(job_id=job["id"])
+        if job is None:
+            return no_update, None, True, ""
+
+        items = job_store.get_items(job_id=scan_data["id"], after=scan_data["seq"])
+        if items:
+            music_table.update_rows(rows=[row for _, row in items])
+        version = music_table.get_version() if items else no_update
+        if job["status"] in ("queued", "running"):
+            scan_data = {"id": scan_data["id"], "seq": items[-1][0]} if items else no_update
+            return version, scan_data, False, job["message"]
+        message = "" if job["status"] == "done" else f"Identification of the new files stopped: {job['message']}"
+        return version, None, True, message
+
+    @callback(
+        Output({"name": "job_store", "type": "store", "page": "generate"}, "data"),
+        Output({"name": "job_cancel", "type": "button", "page": "generate"}, "disabled"),
+        Input({"name": "generate_run", "type": "button", "page": "generate"}, "n_clicks"),
+        State({"name": "music_table", "type": "table", "page": "index"}, "filterModel"),
+    )
+    def generate_run(n_clicks: int, filter_model: Optional[Dict]) -> tuple[Any | Dict, Any | bool]:
+        """
+        Callback function that defines the behavior for the run button on the generate page.
+        The function takes the rows of the table that pass its filters and submits a background job that renders
+        them into a pdf file with QR codes that can be cut up using scissors to create the cards. Only the filters
+        are sent by the page, the rows are selected on the server. The progress of the job is followed by poll_job.
+        """
+        if not n_clicks:
+            return no_update, no_update
+
+        row_data_virtual = music_table.select(filter_model=filter_model)
+        if len(row_data_virtual) == 0:
+            return no_update, no_update
+
+        job_id = job_runner.submit("generate", current_user.get_id(), generate_deck, row_data_virtual)
+        return {"id": job_id}, False
+
+    @callback(
+        Output({"name": "job_store", "type": "store", "page": "generate"}, "data", allow_duplicate=True),
+        Output({"name": "job_cancel", "type": "button", "page": "generate"}, "disabled", allow_duplicate=True),
+        Input({"name": "duplicates_run", "type": "button", "page": "generate"}, "n_clicks"),
+        prevent_initial_call=True,
+    )
+    def duplicates_run(n_clicks: int) -> tuple[Any | Dict, Any | bool]:
+        """
+        Submits a background job that finds the near-duplicate recordings of the library. Its progress is followed by
+        poll_job like the generation of a deck.
+        """
+        if not n_clicks:
+            return no_update, no_update
+
+        job_id = duplicate_runner.submit("duplicates", current_user.get_id(), find_duplicates)
+        return {"id": job_id}, False
 
     @callback(
-        Output({"name": "music_store", "type": "store", "page": "generate"}, "data"),
+        Output({"name": "job_poll", "type": "interval", "page": "generate"}, "disabled"),
+        Output({"name": "job", "type": "div", "page": "generate"}, "style"),
+        Output({"name": "job_progress", "type": "progress", "page": "generate"}, "value"),
+        Output({"name": "job_message", "type": "text", "page": "generate"}, "children"),
+        Output({"name": "job_store", "type": "store", "page": "generate"}, "data", allow_duplicate=True),
+        Output({"name": "table_version", "type": "store", "page": "generate"}, "data", allow_duplicate=True),
         Output({"name": "feedback", "type": "alert", "page": "generate"}, "color"),
         Output({"name": "feedback", "type": "alert", "page": "generate"}, "title"),
         Output({"name": "feedback", "type": "alert", "page": "generate"}, "children"),
         Output({"name": "feedback", "type": "alert", "page": "generate"}, "hide"),
         Output({"name": "download", "type": "download", "page": "generate"}, "data"),
-        Input({"name": "generate_run", "type": "button", "page": "generate"}, "n_clicks"),
-        State({"name": "music_table", "type": "table", "page": "index"}, "rowData"),
-        State({"name": "music_table", "type": "table", "page": "index"}, "virtualRowData"),
+        Input({"name": "job_poll", "type": "interval", "page": "generate"}, "n_intervals"),
+        Input({"name": "job_store", "type": "store", "page": "generate"}, "data"),
+        State({"name": "job", "type": "div", "page": "generate"}, "style"),
+        prevent_initial_call="initial_duplicate",
     )
-    def generate_run(
-        n_clicks: int,
-        row_data: List[Dict],
-        row_data_virtual: List[Dict],
-    ) -> tuple[Any | List[Dict], Any | str, Any | str, Any | str, Any | bool, Any | Dict]:
+    def poll_job(n_intervals: int, job_data: Optional[Dict], style: Dict) -> tuple:
         """
-        Callback function that defines the behavior for the run button on the generate page.
-        The function takes the content of the table on the page and renders all the currently shown rows
-        into a pdf file with QR codes that can be cut up using scissors to create the cards.
-        """
-        if not n_clicks or not row_data or not row_data_virtual or len(row_data) == 0 or len(row_data_virtual) == 0:
-            return no_update, no_update, no_update, no_update, no_update, no_update
-
-        try:
-            # Set up the dataframes
-            df = pd.DataFrame(row_data)
-            df.drop_duplicates(inplace=True)
-            df_virtual = pd.DataFrame(row_data_virtual)
-            df_virtual.drop_duplicates(inplace=True)
-            df_virtual.dropna(inplace=True, subset=["filename", "artist", "title", "year"])  # Rows must have these tags
-            df_virtual["hash"] = [
-                calculate_hash(f"{artist}{title}{year}") for artist, title, year in zip(
-                    df_virtual["artist"], df_virtual["title"], df_virtual["year"]
-                )
-            ]
-
-            # Mark saved files
-            filenames = df_virtual["filename"]
-            mask = df["filename"].isin(filenames)
-
-            # Update the columns in the basic DataFrame
-            df = df.merge(df_virtual[["filename", "hash"]], on="filename", how="left", suffixes=('', "_new"))  # Merge
-            df["hash"] = df["hash_new"].combine_first(df["hash"])  # Prioritize the new values
-            df.drop(columns=["hash_new"], inplace=True)  # Clean up
-            df.loc[mask, "saved"] = True
-
-            # Save current Dataframe to pickle
-            df.to_pickle(VibesterConfig.path_db)
-
-            # Send virtual files to generator
-            directories = sorted([re.sub(r'[^a-zA-Z0-9]', '', x) for x in df_virtual["directory"].unique()])
-            timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-            output_filename = f"output_{'_'.join(directories)}_{timestamp}.pdf"
-            generate(df=df_virtual, filename=output_filename)
-            write_id3_tags_batch(df=df_virtual)
-
-            # Return successful message on the page
-            return (
-                df.to_dict("records"),
-                "green",
-                "Success",
-                f"Records saved to {output_filename}",
-                False,
-                dcc.send_file(os.path.join(VibesterConfig.path_output, output_filename))
-            )
-
-        except Exception as e:
-            return no_update, "red", "Error", f"{e}", False, no_update
+        Follows the deck generation job of the page: shows its progress while it runs, then offers the pdf file for
+        download and updates the table with the saved cards. The job is kept in the session storage, so it is picked
+        up again when the user comes back to the page. A duplicate search is followed the same way, it offers its
+        report and numbers the groups of duplicates in the table. A job that is neither finished nor active in its
+        runner was started by a server process that was stopped, it is marked as failed.
+        """
+        job = job_store.get(job_id=job_data["id"]) if job_data else None
+        runner = duplicate_runner if job is not None and job["kind"] == "duplicates" else job_runner
+        if job is not None and job["status"] in ("queued", "running") and not runner.is_active(job_id=job["id"]):
+            job_store.finish(job_id=job["id"], status="failed", message="The server was stopped before the job ended")
+            job = job_store.get(job_id=job["id"])
+        if job is None:
+            return True, {**style, "display": "none"}, 0, "", no_update, *[no_update] * 6
+
+        progress, message = round(100 * job["progress"]), job["message"]
+        if job["status"] in ("queued", "running"):
+            return False, {**style, "display": "block"}, progress, message, no_update, *[no_update] * 6
+
+        hidden = {**style, "display": "none"}
+        if job["status"] == "cancelled":
+            return True, hidden, progress, message, None, no_update, "yellow", "Cancelled", message, False, no_update
+        if job["status"] == "failed":
+            return True, hidden, progress, message, None, no_update, "red", "Error", message, False, no_update
+
+        output_filename = job["result"]["filename"]
+        if job["kind"] == "duplicates":
+            groups = job["result"]["groups"]
+            music_table.set_duplicates(groups=groups)
+            feedback = f"Found {len(groups)} groups of duplicates, report saved to {output_filename}"
+        else:
+            music_table.mark_saved(hashes=job["result"]["hashes"])  # Mark the cards of the deck as saved in the table
+            feedback = f"Records saved to {output_filename}"
+
+        return (
+            True,
+            hidden,
+            100,
+            message,
+            None,
+            music_table.get_version(),
+            "green",
+            "Success",
+            feedback,
+            False,
+            dcc.send_file(os.path.join(VibesterConfig.path_output, output_filename)),
+        )
+
+    @callback(
+        Output({"name": "job_cancel", "type": "button", "page": "generate"}, "disabled", allow_duplicate=True),
+        Input({"name": "job_cancel", "type": "button", "page": "generate"}, "n_clicks"),
+        State({"name": "job_store", "type": "store", "page": "generate"}, "data"),
+        prevent_initial_call=True,
+    )
+    def cancel_job(n_clicks: int, job_data: Optional[Dict]) -> bool:
+        """
+        Requests the cancellation of the deck generation job of the page. The job stops at its next progress report.
+        """
+        if not n_clicks or not job_data:
+            return no_update
+        job_store.cancel(job_id=job_data["id"])
+        return True
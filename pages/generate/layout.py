@@ -1,10 +1,11 @@
+import uuid
 from dash import html, dcc
 import dash_ag_grid as dag
 from config import VibesterConfig
 from dash_iconify import DashIconify
 import dash_mantine_components as dmc
-from components.buttons import button_big
 from components.loading import loading
+from components.buttons import button_big
 
 
 def get_layout() -> html.Div:
@@ -39,9 +40,16 @@ def get_layout() -> html.Div:
                                         "flexGrow": 1
                                     },
                                     children=[
+                                        dmc.Text(
+                                            id={"name": "scan_message", "type": "text", "page": "generate"},
+                                            children="",
+                                            size="sm",
+                                            style={"paddingBottom": "10px"},
+                                        ),
                                         loading(
                                             name="loader",
                                             page="generate",
+                                            delay_show=500,  # No flicker while the scanned rows stream in
                                             children=[
                                                 dag.AgGrid(
                                                     id={"name": "music_table", "type": "table", "page": "index"},
@@ -52,11 +60,24 @@ def get_layout() -> html.Div:
                                                             "field": x,
                                                             "headerName": x.capitalize(),
                                                             "tooltipField": x,
-                                                            "editable": True,
+                                                            "editable": (
+                                                                x in VibesterConfig.generate_table_editable_cols
+                                                            ),
+                                                            "filter": (
+                                                                "agNumberColumnFilter" if x == "year"
+                                                                else "agTextColumnFilter"
+                                                            ),
                                                         }
                                                         for x in VibesterConfig.generate_table_cols
+                                                    ] + [
+                                                        {  # Group of near-duplicate recordings found by the search
+                                                            "field": "duplicate",
+                                                            "headerName": "Duplicate",
+                                                            "filter": "agNumberColumnFilter",
+                                                        }
                                                     ],
-                                                    rowData=[],
+                                                    rowModelType="infinite",  # Rows are requested from the server
+                                                    getRowId="params.data.path",
                                                     defaultColDef={
                                                         "sortable": True,
                                                         "filter": True,
@@ -64,7 +85,9 @@ def get_layout() -> html.Div:
                                                         "tooltipComponent": None
                                                     },
                                                     dashGridOptions={
-                                                        "enableBrowserTooltips": True
+                                                        "enableBrowserTooltips": True,
+                                                        "cacheBlockSize": VibesterConfig.table_block_size,
+                                                        "maxBlocksInCache": VibesterConfig.table_max_blocks,
                                                     },
                                                     style={
                                                         "width": "100%",
@@ -92,6 +115,57 @@ def get_layout() -> html.Div:
                             )
                         ]
                     ),
+                    dmc.GridCol(
+                        span=12,
+                        children=[
+                            button_big(
+                                name="duplicates_run",
+                                page="generate",
+                                children=[
+                                    DashIconify(
+                                        icon="ion:copy",
+                                        width=100,
+                                    )
+                                ]
+                            )
+                        ]
+                    ),
+                    dmc.GridCol(
+                        span=12,
+                        children=[
+                            dmc.Center(
+                                html.Div(
+                                    id={"name": "job", "type": "div", "page": "generate"},
+                                    style={"width": f"{4 * VibesterConfig.ui_scale}px", "display": "none"},
+                                    children=[
+                                        dmc.Progress(
+                                            id={"name": "job_progress", "type": "progress", "page": "generate"},
+                                            value=0,
+                                            size="xl",
+                                            striped=True,
+                                            animated=True,
+                                        ),
+                                        dmc.Group(
+                                            justify="space-between",
+                                            style={"paddingTop": "10px"},
+                                            children=[
+                                                dmc.Text(
+                                                    id={"name": "job_message", "type": "text", "page": "generate"},
+                                                    children="",
+                                                ),
+                                                dmc.Button(
+                                                    "Cancel",
+                                                    id={"name": "job_cancel", "type": "button", "page": "generate"},
+                                                    variant="outline",
+                                                    color="red",
+                                                ),
+                                            ]
+                                        ),
+                                    ]
+                                )
+                            )
+                        ]
+                    ),
                     dmc.GridCol(
                         span=12,
                         children=[
@@ -115,7 +189,21 @@ def get_layout() -> html.Div:
                         ]
                     ),
                     dcc.Download(id={"name": "download", "type": "download", "page": "generate"}),
-                    dcc.Store(id={"name": "music_store", "type": "store", "page": "generate"}, data=[])
+                    dcc.Interval(
+                        id={"name": "job_poll", "type": "interval", "page": "generate"},
+                        interval=VibesterConfig.job_poll_interval,
+                        disabled=True,
+                    ),
+                    dcc.Store(id={"name": "job_store", "type": "store", "page": "generate"}, storage_type="session"),
+                    dcc.Interval(
+                        id={"name": "scan_poll", "type": "interval", "page": "generate"},
+                        interval=VibesterConfig.job_poll_interval,
+                        disabled=True,
+                    ),
+                    dcc.Store(id={"name": "scan_store", "type": "store", "page": "generate"}, storage_type="session"),
+                    dcc.Store(id={"name": "table_version", "type": "store", "page": "generate"}, data=0),
+                    dcc.Store(id={"name": "dummy", "type": "store", "page": "generate"}, data=""),
+                    dcc.Store(id={"name": "table_session", "type": "store", "page": "generate"}, data=uuid.uuid4().hex),
                 ]
             )
         ]
@@ -0,0 +1,265 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import tarfile
+import threading
+from config import VibesterConfig
+from pages.generate.providers import ProviderCache
+from typing import Optional, Dict, List, Iterator, Callable, Tuple, IO
+
+# Columns kept from the tables of the MusicBrainz dump, by their position in the tab-separated files
+dump_tables = {
+    "recording": ("id INTEGER PRIMARY KEY, gid TEXT, name TEXT, artist_credit INTEGER", [0, 1, 2, 3]),
+    "artist_credit": ("id INTEGER PRIMARY KEY, name TEXT", [0, 1]),
+    "artist_credit_name": ("artist_credit INTEGER, position INTEGER, artist INTEGER", [0, 1, 2]),
+    "artist": ("id INTEGER PRIMARY KEY, name TEXT", [0, 2]),
+    "track": ("recording INTEGER, medium INTEGER", [2, 3]),
+    "medium": ("id INTEGER PRIMARY KEY, release INTEGER", [0, 1]),
+    "release_country": ("release INTEGER, date_year INTEGER", [0, 2]),
+    "release_unknown_country": ("release INTEGER, date_year INTEGER", [0, 1]),
+    "recording_first_release_date": ("recording INTEGER PRIMARY KEY, year INTEGER", [0, 1]),
+    "tag": ("id INTEGER PRIMARY KEY, name TEXT", [0, 1]),
+    "artist_tag": ("artist INTEGER, tag INTEGER, count INTEGER", [0, 1, 2]),
+}
+required_tables = ["recording", "artist_credit"]
+release_tables = ["track", "medium", "release_country", "release_unknown_country"]  # Not needed with the first releases
+escapes = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v", "\\": "\\"}
+
+
+def parse_dump_line(line: str, columns: List[int]) -> List[Optional[str]]:
+    """
+    Parses a line of a table of the MusicBrainz dump, which is in the text format of PostgreSQL COPY: the fields are
+    separated by tabs, \\N is NULL and special characters are escaped with a backslash.
+    """
+    fields = line.rstrip("\n").split("\t")
+    values = []
+    for i in columns:
+        field = fields[i] if i < len(fields) else None
+        if field == "\\N":
+            field = None
+        elif field is not None and "\\" in field:
+            field = re.sub(r"\\(.)", lambda match: escapes.get(match.group(1), match.group(1)), field)
+        values.append(field)
+    return values
+
+
+def iter_dump_files(paths: List[str]) -> Iterator[Tuple[str, IO[bytes]]]:
+    """
+    Yields the name and the content of the tables in the given MusicBrainz dumps. A dump is either an extracted
+    mbdump folder or a (compressed) tar archive such as mbdump.tar.bz2, which is read without extracting it.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name in dump_tables:
+                    with open(os.path.join(path, name), "rb") as f:
+                        yield name, f
+        else:
+            with tarfile.open(path, "r|*") as archive:  # Streamed, the members are read in the order of the archive
+                for member in archive:
+                    name = os.path.basename(member.name)
+                    if member.isfile() and os.path.dirname(member.name).endswith("mbdump") and name in dump_tables:
+                        yield name, archive.extractfile(member)
+
+
+class MusicBrainzIndex:
+    """
+    Local copy of the MusicBrainz metadata the identification needs, imported from a MusicBrainz data dump into
+    SQLite: the title, the artists, the earliest release year and the tags of the artist of every recording, and the
+    earliest release year of every artist and title. Lookups that hit the index don't wait for the rate limit
+    of the MusicBrainz API. The index is read-only for the server, an import builds a new file that replaces the old
+    one at once.
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.local = threading.local()  # One connection per thread
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """
+        Returns the read-only connection of the current thread to the index, or None if no dump was imported. The
+        connection is reopened when an import replaced the file.
+        """
+        try:
+            stat = os.stat(self.filepath)
+        except OSError:
+            return None
+        key = (os.getpid(), stat.st_ino, stat.st_mtime_ns)
+        if getattr(self.local, "key", None) != key:
+            connection = sqlite3.connect(f"file:{self.filepath}?mode=ro", uri=True)
+            connection.row_factory = sqlite3.Row
+            self.local.connection, self.local.key = connection, key
+        return self.local.connection
+
+    def get_recording(self, recording_id: str) -> Optional[Dict[str, Optional[str]]]:
+        """
+        Returns the title, the artist, the release year and the genre of a recording by its MusicBrainz ID, in the
+        format of query_musicbrainz, or None if the recording is not in the index.
+        """
+        connection = self._connect()
+        if connection is None:
+            return None
+        row = connection.execute(
+            "SELECT title, artist, year, genre FROM recordings WHERE gid = ?", (recording_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        year = str(row["year"]) if row["year"] is not None else ""
+        return {"title": row["title"] or "", "artist": row["artist"] or "", "year": year, "genre": row["genre"] or ""}
+
+    def find_year(self, artist: str, title: str) -> Optional[str]:
+        """
+        Returns the earliest release year of the recordings of an artist with a title, or None if there are none.
+        The artist is either the names of the artists joined with ", " like query_musicbrainz gives it, or the artist
+        credit, e.g. "A & B". Differences in case, Unicode composition and whitespace are ignored.
+        """
+        connection = self._connect()
+        if connection is None:
+            return None
+        row = connection.execute(
+            "SELECT year FROM titles WHERE artist_key = ? AND title_key = ?",
+            (ProviderCache.normalize(artist), ProviderCache.normalize(title)),
+        ).fetchone()
+        return str(row["year"]) if row is not None else None
+
+    def import_dump(self, paths: List[str], progress: Optional[Callable[[str], None]] = print) -> Dict[str, int]:
+        """
+        Imports the MusicBrainz dumps at the given paths and replaces the index with them. The recording and
+        artist_credit tables are required; the release dates come from recording_first_release_date, or from the
+        track, medium and release_(unknown_)country tables, the names of the artists from the artist_credit_name and
+        artist tables, and the genres from artist_credit_name and the artist_tag and tag tables (in mbdump-derived).
+        The tables of the releases, the largest of the dump, are skipped if the dump has recording_first_release_date;
+        in an archive, only those after it. Returns the number of rows imported per table.
+        """
+        progress = progress or (lambda message: None)
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+        target, staging = f"{self.filepath}.import", f"{self.filepath}.staging"
+        for filepath in (target, staging):
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+        connection = sqlite3.connect(target)
+        try:
+            connection.execute("PRAGMA journal_mode=OFF")  # A failed import is started again from scratch
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("ATTACH DATABASE ? AS staging", (staging,))
+            connection.execute("PRAGMA staging.journal_mode=OFF")
+            connection.execute("PRAGMA staging.synchronous=OFF")
+            connection.create_function("normalize", 1, ProviderCache.normalize, deterministic=True)
+            for table, (schema, _) in dump_tables.items():
+                connection.execute(f"CREATE TABLE staging.{table} ({schema})")
+
+            counts = dict()
+            first_release_dates = any(
+                os.path.isfile(os.path.join(path, "recording_first_release_date")) for path in paths
+            )
+            for table, f in iter_dump_files(paths=paths):
+                if table in release_tables and (first_release_dates or counts.get("recording_first_release_date")):
+                    progress(f"Skipped {table}, the release dates are in recording_first_release_date")
+                    continue
+                started, columns = time.time(), dump_tables[table][1]
+                placeholders = ", ".join("?" * len(columns))
+                rows = (parse_dump_line(line=line.decode("utf-8"), columns=columns) for line in f)
+                with connection:
+                    connection.executemany(f"INSERT INTO staging.{table} VALUES ({placeholders})", rows)
+                counts[table] = connection.execute(f"SELECT COUNT(*) FROM staging.{table}").fetchone()[0]
+                progress(f"Loaded {counts[table]} rows of {table} in {time.time() - started:.0f} s")
+            missing = [table for table in required_tables if not counts.get(table)]
+            if missing:
+                raise ValueError(f"The dump has no {', '.join(missing)} table")
+
+            progress("Building the index")
+            with connection:
+                self._build(connection=connection, first_release_dates=bool(counts.get("recording_first_release_date")))
+            connection.execute("DETACH DATABASE staging")
+        finally:
+            connection.close()
+            if os.path.exists(staging):
+                os.remove(staging)
+
+        os.replace(target, self.filepath)  # Lookups switch to the new index on their next query
+        progress(f"Imported the MusicBrainz dump to {self.filepath}")
+        return counts
+
+    @staticmethod
+    def _build(connection: sqlite3.Connection, first_release_dates: bool) -> None:
+        """
+        Builds the tables of the index from the staging tables of the dump.
+        """
+        if first_release_dates:
+            connection.execute(
+                "CREATE TEMP TABLE first_release AS SELECT recording, year FROM staging.recording_first_release_date "
+                "WHERE year IS NOT NULL"
+            )
+        else:  # The earliest release of any medium the recording is on
+            connection.execute(
+                "CREATE TEMP TABLE release_year AS SELECT release, MIN(date_year) AS year FROM ("
+                "SELECT release, date_year FROM staging.release_country UNION ALL "
+                "SELECT release, date_year FROM staging.release_unknown_country"
+                ") WHERE date_year IS NOT NULL GROUP BY release"
+            )
+            connection.execute("CREATE INDEX temp.release_year_release ON release_year (release)")
+            connection.execute(
+                "CREATE TEMP TABLE first_release AS SELECT track.recording, MIN(release_year.year) AS year "
+                "FROM staging.track JOIN staging.medium ON medium.id = track.medium "
+                "JOIN release_year ON release_year.release = medium.release GROUP BY track.recording"
+            )
+        connection.execute("CREATE INDEX temp.first_release_recording ON first_release (recording)")
+
+        # Tags of the first artist of each artist credit, like the artist tag list of the MusicBrainz API
+        connection.execute("CREATE INDEX staging.artist_tag_artist ON artist_tag (artist)")
+        connection.execute(
+            "CREATE TEMP TABLE credit_genre AS SELECT artist_credit, group_concat(name, ';') AS genre FROM ("
+            "SELECT artist_credit_name.artist_credit, tag.name FROM staging.artist_credit_name "
+            "JOIN staging.artist_tag ON artist_tag.artist = artist_credit_name.artist "
+            "JOIN staging.tag ON tag.id = artist_tag.tag "
+            "WHERE artist_credit_name.position = 0 AND artist_tag.count > 0 "
+            "ORDER BY artist_credit_name.artist_credit, artist_tag.count DESC"
+            ") GROUP BY artist_credit"
+        )
+        connection.execute("CREATE INDEX temp.credit_genre_artist_credit ON credit_genre (artist_credit)")
+
+        # Names of the artists of each artist credit in their order, joined like query_musicbrainz joins them
+        connection.execute(
+            "CREATE TEMP TABLE credit_artists AS SELECT artist_credit, group_concat(name, ', ') AS artist FROM ("
+            "SELECT artist_credit_name.artist_credit, artist.name FROM staging.artist_credit_name "
+            "JOIN staging.artist ON artist.id = artist_credit_name.artist "
+            "ORDER BY artist_credit_name.artist_credit, artist_credit_name.position"
+            ") GROUP BY artist_credit"
+        )
+        connection.execute("CREATE INDEX temp.credit_artists_artist_credit ON credit_artists (artist_credit)")
+
+        connection.execute(
+            "CREATE TABLE recordings (gid TEXT PRIMARY KEY, title TEXT, artist TEXT, year INTEGER, genre TEXT)"
+        )
+        connection.execute(
+            "INSERT INTO recordings SELECT recording.gid, recording.name, "
+            "COALESCE(credit_artists.artist, artist_credit.name), first_release.year, credit_genre.genre "
+            "FROM staging.recording "
+            "LEFT JOIN staging.artist_credit ON artist_credit.id = recording.artist_credit "
+            "LEFT JOIN credit_artists ON credit_artists.artist_credit = recording.artist_credit "
+            "LEFT JOIN first_release ON first_release.recording = recording.id "
+            "LEFT JOIN credit_genre ON credit_genre.artist_credit = recording.artist_credit"
+        )
+        connection.execute(
+            "CREATE TABLE titles (artist_key TEXT, title_key TEXT, year INTEGER, PRIMARY KEY (artist_key, title_key)) "
+            "WITHOUT ROWID"
+        )
+        connection.execute(  # Keyed by the names of the artists and by the artist credit, as tags often hold the latter
+            "INSERT INTO titles SELECT normalize(artist), normalize(title), MIN(year) FROM ("
+            "SELECT artist, title, year FROM recordings UNION ALL "
+            "SELECT artist_credit.name, recording.name, first_release.year FROM staging.recording "
+            "JOIN staging.artist_credit ON artist_credit.id = recording.artist_credit "
+            "JOIN first_release ON first_release.recording = recording.id"
+            ") WHERE year IS NOT NULL AND artist IS NOT NULL AND title IS NOT NULL GROUP BY 1, 2"
+        )
+
+
+musicbrainz_index = MusicBrainzIndex(filepath=VibesterConfig.path_musicbrainz_index)
+
+
+if __name__ == "__main__":
+    # Imports a MusicBrainz data dump, e.g. mbdump.tar.bz2 and mbdump-derived.tar.bz2 or the extracted mbdump folders
+    # Usage: python -m pages.generate.musicbrainz_index <dump> [<dump> ...]
+    musicbrainz_index.import_dump(paths=sys.argv[1:])
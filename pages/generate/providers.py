@@ -0,0 +1,346 @@
+import json
+import time
+import httpx
+import sqlite3
+import asyncio
+import inspect
+import datetime
+import threading
+import unicodedata
+import concurrent.futures
+from functools import wraps
+from utils.sqlite import connect
+from config import VibesterConfig
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Coroutine, Callable, Tuple
+
+
+class AsyncRateLimiter:
+    """
+    Token bucket rate limiter for the requests sent to a single metadata provider.
+    Tokens are refilled at rate per second up to burst, and every request takes one token or waits until there is one.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """
+        Waits until a request may be sent to the provider. Requests are let through in the order they arrived.
+        """
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens, self.updated = 1.0, time.monotonic()
+            self.tokens -= 1
+
+
+class ProviderUnavailable(Exception):
+    """
+    Raised when a provider is skipped because its circuit breaker is open.
+    """
+
+
+def is_provider_failure(error: Exception) -> bool:
+    """
+    Decides if an error raised by a blocking provider client means that the provider is failing, like the timeouts,
+    network errors, 429 and 5xx answers request() counts. Other answers, e.g. 404 for a recording that was merged or
+    deleted, come from a working provider. Errors without an HTTP status count as failures.
+    """
+    cause = getattr(error, "cause", None)  # musicbrainzngs wraps the urllib error
+    status = getattr(error, "status_code", None) or getattr(cause, "code", None)  # discogs_client sets status_code
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return True
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a single metadata provider. After failure_threshold failed requests in a row the provider is
+    skipped for cooldown seconds, then a single request is let through to probe it: a success closes the breaker,
+    a failure skips the provider for another cooldown.
+    """
+    def __init__(self, name: str, failure_threshold: int, cooldown: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = 0.0  # Time the breaker was opened or the last probe was let through
+
+    def allow(self) -> bool:
+        """
+        Decides if a request may be sent to the provider.
+        """
+        if self.failures < self.failure_threshold:
+            return True
+        if time.monotonic() - self.opened >= self.cooldown:
+            self.opened = time.monotonic()  # Only one probe per cooldown
+            return True
+        return False
+
+    def record_success(self) -> None:
+        """
+        Closes the breaker.
+        """
+        if self.failures >= self.failure_threshold:
+            print(f"Metadata provider {self.name} is available again")
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        """
+        Counts a failed request and opens the breaker when there were too many in a row.
+        """
+        self.failures += 1
+        if self.failures == self.failure_threshold:
+            print(f"Metadata provider {self.name} failed {self.failures} times, skipping it for {self.cooldown} s")
+        if self.failures >= self.failure_threshold:
+            self.opened = time.monotonic()
+
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    """
+    Returns the seconds to wait before a retry as requested by the Retry-After header of a response, if there is one.
+    The header is either a number of seconds or an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderLoop:
+    """
+    Event loop running in a background thread that issues the requests to the metadata providers.
+    Lookups from every callback are run on the same loop, so they share the HTTP connections and each provider's rate
+    limiter and circuit breaker hold across tracks and concurrent users.
+    """
+    def __init__(self, rate_limits: Dict[str, Dict[str, float]]):
+        self.rate_limits = rate_limits
+        self.lock = threading.Lock()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None  # Started on the first lookup
+        self.client: Optional[httpx.AsyncClient] = None
+        self.limiters: Dict[str, AsyncRateLimiter] = dict()
+        self.breakers: Dict[str, CircuitBreaker] = dict()
+
+    def submit(self, coroutine: Coroutine) -> concurrent.futures.Future:
+        """
+        Schedules a coroutine on the provider loop and returns a future of its result. Cancelling the future cancels
+        the coroutine.
+        """
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="metadata-providers", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Coroutine) -> Any:
+        """
+        Runs a coroutine on the provider loop and waits for its result. Must not be called from the loop itself.
+        """
+        return self.submit(coroutine).result()
+
+    def get_client(self) -> httpx.AsyncClient:
+        """
+        Returns the HTTP client shared by the providers. It keeps the connections to every provider alive, so the
+        TLS handshake is only paid once. Must be called on the provider loop.
+        """
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    VibesterConfig.provider_read_timeout,
+                    connect=VibesterConfig.provider_connect_timeout,
+                ),
+                limits=httpx.Limits(max_connections=VibesterConfig.provider_max_connections),
+            )
+        return self.client
+
+    async def limit(self, provider: str) -> None:
+        """
+        Waits for the rate limiter of a provider before a request is sent to it.
+        """
+        if provider not in self.limiters:
+            self.limiters[provider] = AsyncRateLimiter(**self.rate_limits[provider])
+        await self.limiters[provider].acquire()
+
+    def get_breaker(self, provider: str) -> CircuitBreaker:
+        """
+        Returns the circuit breaker of a provider.
+        """
+        if provider not in self.breakers:
+            self.breakers[provider] = CircuitBreaker(
+                name=provider,
+                failure_threshold=VibesterConfig.provider_failure_threshold,
+                cooldown=VibesterConfig.provider_cooldown,
+            )
+        return self.breakers[provider]
+
+    async def request(self, provider: str, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """
+        Sends an HTTP request to a provider through its rate limiter and circuit breaker. Timeouts, connection errors,
+        429 and 5xx answers are retried at most provider_retries times with exponential backoff, or after the time
+        requested by the Retry-After header. Raises the last error if every attempt failed, other answers are returned.
+        """
+        breaker = self.get_breaker(provider)
+        if not breaker.allow():
+            raise ProviderUnavailable(f"Metadata provider {provider} is skipped after repeated failures")
+
+        for attempt in range(VibesterConfig.provider_retries + 1):
+            await self.limit(provider)
+            try:
+                response = await self.get_client().request(method, url, **kwargs)
+            except httpx.TransportError as e:  # Includes the timeouts
+                error, wait = e, None
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    breaker.record_success()
+                    return response
+                error = httpx.HTTPStatusError(
+                    f"{response.status_code} from {provider}", request=response.request, response=response
+                )
+                wait = get_retry_after(response)
+
+            wait = VibesterConfig.provider_backoff * 2 ** attempt if wait is None else wait
+            if attempt == VibesterConfig.provider_retries or wait > VibesterConfig.provider_max_retry_wait:
+                break
+            await asyncio.sleep(wait)
+
+        breaker.record_failure()
+        raise error
+
+    async def call(self, provider: str, f: Callable, *args: Any, **kwargs: Any) -> Any:
+        """
+        Runs a blocking provider client (e.g. musicbrainzngs) in a thread through the rate limiter and the circuit
+        breaker of the provider. The call is given up after the read timeout, so a hung request cannot stall a lookup.
+        Errors are raised, but only those is_provider_failure accepts count as failures of the provider.
+        """
+        breaker = self.get_breaker(provider)
+        if not breaker.allow():
+            raise ProviderUnavailable(f"Metadata provider {provider} is skipped after repeated failures")
+
+        await self.limit(provider)
+        try:
+            timeout = VibesterConfig.provider_connect_timeout + VibesterConfig.provider_read_timeout
+            result = await asyncio.wait_for(asyncio.to_thread(f, *args, **kwargs), timeout=timeout)
+        except Exception as e:
+            if is_provider_failure(error=e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()  # The provider answered
+            raise
+        breaker.record_success()
+        return result
+
+
+class ProviderCache:
+    """
+    Persistent cache of the answers of the metadata providers, stored in SQLite.
+    Answers are keyed by the provider and the normalised arguments of the query, e.g. the artist and the title, so the
+    same track in another folder or a rescan of the library does not reach the network again. "No result" answers are
+    cached too, but they expire after negative_ttl, since the providers keep adding tracks. Errors are never cached.
+    """
+    def __init__(self, filepath: str, ttls: Dict[str, float], negative_ttl: float):
+        self.filepath = filepath
+        self.ttls = ttls
+        self.negative_ttl = negative_ttl
+        self.local = threading.local()  # One connection per thread
+        self.inflight: Dict[Tuple[str, str], asyncio.Future] = dict()  # Queries being answered right now
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Returns the connection of the current thread to the cache and creates the table on the first use.
+        """
+        if getattr(self.local, "connection", None) is None:
+            connection = connect(self.filepath)
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "provider TEXT NOT NULL, key TEXT NOT NULL, value TEXT, created REAL NOT NULL, "
+                    "PRIMARY KEY (provider, key))"
+                )
+            self.local.connection = connection
+        return self.local.connection
+
+    @staticmethod
+    def normalize(*args: Any) -> str:
+        """
+        Creates the key of a query from its arguments.
+        Differences in case, Unicode composition and whitespace are ignored.
+        """
+        parts = [" ".join(unicodedata.normalize("NFKC", str(arg)).casefold().split()) for arg in args]
+        return "\x1f".join(parts)
+
+    def get(self, provider: str, key: str) -> Tuple[bool, Any]:
+        """
+        Looks up the cached answer of a query. Returns whether there was a fresh answer and the answer itself.
+        """
+        row = self._connect().execute(
+            "SELECT value, created FROM responses WHERE provider = ? AND key = ?", (provider, key)
+        ).fetchone()
+        if row is None:
+            return False, None
+        ttl = self.ttls.get(provider, 0) if row["value"] is not None else self.negative_ttl
+        if time.time() - row["created"] > ttl:
+            return False, None
+        return True, json.loads(row["value"]) if row["value"] is not None else None
+
+    def put(self, provider: str, key: str, value: Any) -> None:
+        """
+        Stores the answer of a query. None stores a "no result" answer.
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (provider, key, value, created) VALUES (?, ?, ?, ?)",
+                (provider, key, json.dumps(value) if value is not None else None, time.time()),
+            )
+
+    def cached(self, provider: str) -> Callable:
+        """
+        Decorator that caches the answers of a coroutine function querying a provider, keyed by its arguments.
+        Concurrent calls with the same arguments wait for the first one instead of sending the same request again.
+        The decorated function must be called on the provider loop.
+        """
+        def decorator(f: Callable) -> Callable:
+            signature = inspect.signature(f)
+
+            @wraps(f)
+            async def wrapper(*args: Any, **kwargs: Any) -> Any:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = self.normalize(*bound.arguments.values())
+                hit, value = self.get(provider=provider, key=key)
+                if hit:
+                    return value
+                if (provider, key) in self.inflight:  # The same query of another track, e.g. a shared album
+                    return await asyncio.shield(self.inflight[(provider, key)])
+
+                self.inflight[(provider, key)] = asyncio.ensure_future(f(*args, **kwargs))
+                try:
+                    value = await asyncio.shield(self.inflight[(provider, key)])  # Errors propagate, nothing is cached
+                finally:
+                    del self.inflight[(provider, key)]
+                self.put(provider=provider, key=key, value=value)
+                return value
+            return wrapper
+        return decorator
+
+
+provider_loop = ProviderLoop(rate_limits=VibesterConfig.provider_rate_limits)
+provider_cache = ProviderCache(
+    filepath=VibesterConfig.path_provider_cache,
+    ttls=VibesterConfig.provider_cache_ttl,
+    negative_ttl=VibesterConfig.provider_cache_negative_ttl,
+)
@@ -1,12 +1,17 @@
 import os
 import time
 import requests
+import threading
+from config import VibesterConfig
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
 
 
 class SpotifyTokenGenerator:
     """
     Class that can generate and re-generate a Spotify token.
-    The token is regenerated every 59 minutes as it expires after an hour.
+    The token is regenerated a minute before it expires, which is an hour after it was issued. The token is shared by
+    every thread, and only one of them requests a new token when it is needed.
     """
     def __init__(self):
         self.url = "https://accounts.spotify.com/api/token"
@@ -20,27 +25,55 @@ class SpotifyTokenGenerator:
         self.token_lifespan = 59 * 60
         self.token_init = time.time()
         self.token = None
+        self.lock = threading.Lock()
+
+        # Keep-alive session that retries the token request on connection errors, 429 and 5xx, honouring Retry-After
+        retry = Retry(
+            total=VibesterConfig.provider_retries,
+            backoff_factor=VibesterConfig.provider_backoff,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
 
     def _get_new_token(self) -> str:
         """
         Get an access token from Spotify API.
         """
-        response = requests.post(self.url, headers=self.headers, data=self.data, auth=self.auth)
+        response = self.session.post(
+            self.url,
+            headers=self.headers,
+            data=self.data,
+            auth=self.auth,
+            timeout=(VibesterConfig.provider_connect_timeout, VibesterConfig.provider_read_timeout),
+        )
         response.raise_for_status()
-        token = response.json()["access_token"]
+        content = response.json()
 
         self.token_init = time.time()
-        self.token = token
-        return token
+        self.token_lifespan = content.get("expires_in", 60 * 60) - 60
+        self.token = content["access_token"]
+        return self.token
 
     def get_token(self) -> str:
         """
-        Sets the new access token if it has not been set in the last 59 minutes.
+        Sets the new access token if it is missing or about to expire.
         """
-        current_time = time.time()
+        with self.lock:
+            current_time = time.time()
 
-        # Check if the token is missing or expired
-        if not self.token or (current_time - self.token_init) >= self.token_lifespan:
-            self._get_new_token()  # Get a new token
+            # Check if the token is missing or expired
+            if not self.token or (current_time - self.token_init) >= self.token_lifespan:
+                self._get_new_token()  # Get a new token
 
-        return self.token
+            return self.token
+
+    def invalidate(self, token: str) -> None:
+        """
+        Drops a token that was rejected by Spotify, so the next call gets a new one. If another thread has already
+        replaced the token, the new one is kept.
+        """
+        with self.lock:
+            if self.token == token:
+                self.token = None
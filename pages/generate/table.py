@@ -0,0 +1,282 @@
+import json
+import functools
+import threading
+import pandas as pd
+from loader import load_db
+from config import VibesterConfig
+from library import library_index
+from manifest import scan_manifest
+from collections import OrderedDict
+from typing import Optional, Dict, List, Any, Tuple
+from pages.generate.utils import is_music_file, create_music_record, add_library_path
+
+
+def filter_column(values: pd.Series, model: Dict) -> pd.Series:
+    """
+    Returns the mask of the values of a column that pass its filter, given in the format of the AG Grid filter model.
+    Text filters are case-insensitive, number filters treat values that are not numbers as blank.
+    """
+    if "operator" in model:  # Conditions combined with AND or OR
+        conditions = model.get("conditions") or [model[x] for x in ("condition1", "condition2") if x in model]
+        masks = [filter_column(values=values, model=condition) for condition in conditions]
+        combine = (lambda a, b: a & b) if model["operator"] == "AND" else (lambda a, b: a | b)
+        return functools.reduce(combine, masks)
+
+    kind = model.get("type", "contains")
+    if model.get("filterType") == "number":
+        numbers = pd.to_numeric(values, errors="coerce")
+        value, value_to = model.get("filter"), model.get("filterTo")
+        conditions = {
+            "blank": lambda: numbers.isna(),
+            "notBlank": lambda: numbers.notna(),
+            "equals": lambda: numbers == value,
+            "notEqual": lambda: numbers != value,
+            "lessThan": lambda: numbers < value,
+            "lessThanOrEqual": lambda: numbers <= value,
+            "greaterThan": lambda: numbers > value,
+            "greaterThanOrEqual": lambda: numbers >= value,
+            "inRange": lambda: (numbers >= value) & (numbers <= value_to),
+        }
+    else:
+        text = values.fillna("").astype(str).str.strip().str.casefold()
+        value = str(model.get("filter") or "").casefold()
+        conditions = {
+            "blank": lambda: text == "",
+            "notBlank": lambda: text != "",
+            "equals": lambda: text == value,
+            "notEqual": lambda: text != value,
+            "contains": lambda: text.str.contains(value, regex=False),
+            "notContains": lambda: ~text.str.contains(value, regex=False),
+            "startsWith": lambda: text.str.startswith(value),
+            "endsWith": lambda: text.str.endswith(value),
+        }
+    if kind not in conditions:
+        raise ValueError(f"Unsupported filter type: {kind}")
+    return conditions[kind]()
+
+
+def filter_rows(df: pd.DataFrame, filter_model: Optional[Dict]) -> pd.DataFrame:
+    """
+    Returns the rows that pass the filters of every column in the AG Grid filter model.
+    """
+    mask = pd.Series(True, index=df.index)
+    for column, model in (filter_model or dict()).items():
+        values = df[column] if column in df.columns else pd.Series(None, index=df.index, dtype=object)
+        mask &= filter_column(values=values, model=model)
+    return df[mask]
+
+
+def sort_key(values: pd.Series) -> pd.Series:
+    """
+    Key of the sorting of a column: numbers are sorted as numbers, also if they were edited as text, e.g. the years,
+    everything else is sorted case-insensitively. Blank values are sorted last.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return values
+    numbers = pd.to_numeric(values.map(lambda x: x if isinstance(x, (int, float, str)) else None), errors="coerce")
+    if numbers.notna().sum() == values.notna().sum():
+        return numbers
+    return values.astype("string").str.casefold()
+
+
+def sort_rows(df: pd.DataFrame, sort_model: Optional[List[Dict]]) -> pd.DataFrame:
+    """
+    Sorts the rows by the columns in the AG Grid sort model, in the order of the model.
+    """
+    sort_model = [x for x in sort_model or [] if x["colId"] in df.columns]
+    if not sort_model:
+        return df
+    return df.sort_values(
+        by=[x["colId"] for x in sort_model],
+        ascending=[x["sort"] == "asc" for x in sort_model],
+        key=sort_key,
+        na_position="last",
+        kind="stable",
+    )
+
+
+def to_records(df: pd.DataFrame) -> List[Dict]:
+    """
+    Converts rows to records that can be sent to the browser, with None instead of NaN.
+    """
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+class MusicTable:
+    """
+    Rows of the music table of the generate page, one per music file of the library, kept on the server.
+    The grid of the page requests only the rows it displays, sorted and filtered here, so neither the browser nor the
+    callbacks handle the whole library. The version of the table changes whenever its rows change, which tells the
+    page to request the displayed rows again.
+    The table is shared by every page. Cells edited on a page are kept apart from the rows built from the DB and
+    applied on top of them whenever the rows are rebuilt, until the deck they are saved with is generated.
+    """
+    def __init__(self, max_views: int):
+        self.lock = threading.Lock()
+        self.df: Optional[pd.DataFrame] = None  # Rows indexed by the path relative to the music folder
+        self.version = 0
+        self.max_views = max_views
+        self.views: OrderedDict[str, Tuple[str, pd.DataFrame]] = OrderedDict()  # Page -> sorted and filtered rows
+        self.edits: Dict[str, Dict[str, Any]] = dict()  # Path -> edited cells of the rows that were not saved yet
+        self.duplicates: Dict[str, int] = dict()  # Path -> group of near-duplicate recordings it belongs to
+
+    def _changed(self) -> None:
+        """
+        Registers a change of the rows. The lock must be held.
+        """
+        self.version += 1
+        self.views.clear()
+
+    def _apply_edits(self, paths: pd.Index) -> None:
+        """
+        Applies the cells edited on the pages to the given rows. The lock must be held.
+        """
+        for path in paths.intersection(list(self.edits)):
+            for column, value in self.edits[path].items():
+                if column not in self.df.columns:
+                    self.df[column] = None
+                self.df[column] = self.df[column].astype(object)
+                self.df.at[path, column] = value
+
+    def load(self) -> List[Tuple[str, str]]:
+        """
+        Builds the rows from the DB, and the music files that are not in the DB from the scan manifest. Returns the
+        (filename, relative path) pairs of the files that were never identified, their rows are added empty.
+        """
+        df_db = load_db()
+        known = {  # The first record of each file in the DB, keyed by filename for constant time lookups
+            record["filename"]: record
+            for record in df_db.drop_duplicates(keep="first", subset="filename").to_dict("records")
+        }
+
+        records, unidentified = [], []
+        for filename, relpath in library_index.items():  # Single pass over the indexed library
+            if not is_music_file(filename):
+                continue
+
+            record = known.get(filename)
+            if record is None:  # Music file not in the database yet
+                content_hash = library_index.get_content_hash(relpath=relpath, calculate=False)  # Never hashes
+                music_metadata = scan_manifest.get(content_hash=content_hash)  # Identified on an earlier visit
+                if music_metadata is None:
+                    unidentified.append((filename, relpath))
+                record = create_music_record(filename=filename, metadata=music_metadata)
+            records.append(add_library_path(record=record, relpath=relpath))
+
+        df = pd.DataFrame(records or [{"path": None, "filename": None}], dtype=object)  # Kept as they are, e.g. years
+        df = df.dropna(subset=["path"])
+        with self.lock:
+            self.df = df.set_index("path", drop=False)
+            self.df["duplicate"] = pd.Series([self.duplicates.get(x) for x in self.df["path"]], self.df.index, object)
+            self._apply_edits(paths=self.df.index)
+            self._changed()
+        return unidentified
+
+    def get_version(self) -> int:
+        """
+        Returns the version of the rows.
+        """
+        with self.lock:
+            return self.version
+
+    def _get_df(self) -> pd.DataFrame:
+        """
+        Returns the rows, loading them first if the table is used before the page loaded it.
+        """
+        if self.df is None:
+            self.load()
+        return self.df
+
+    def update_rows(self, rows: List[Dict]) -> None:
+        """
+        Replaces the rows of music files, e.g. the rows found by the background scan of the library.
+        """
+        self._get_df()
+        with self.lock:
+            rows = [row for row in rows if row["path"] in self.df.index]  # Files removed since the table was loaded
+            if not rows:
+                return None
+            df_rows = pd.DataFrame(rows).set_index("path", drop=False)
+            for column in df_rows.columns.difference(self.df.columns):
+                self.df[column] = None
+            self.df = self.df.astype({column: object for column in df_rows.columns})
+            self.df.loc[df_rows.index, df_rows.columns] = df_rows
+            self._apply_edits(paths=df_rows.index)
+            self._changed()
+
+    def edit(self, path: str, column: str, value: Any) -> None:
+        """
+        Stores the value of a cell edited on the page. Only the tags in generate_table_editable_cols can be edited.
+        """
+        if column not in VibesterConfig.generate_table_editable_cols:  # e.g. the path identifies the row
+            return None
+        self._get_df()
+        with self.lock:
+            if path not in self.df.index:
+                return None
+            self.edits.setdefault(path, dict())[column] = value
+            self.df[column] = self.df[column].astype(object)
+            self.df.at[path, column] = value
+            self._changed()
+
+    def mark_saved(self, hashes: Dict[str, str]) -> None:
+        """
+        Marks the rows of the cards of a generated deck as saved, given the hashes of the cards by filename. Their
+        edited cells were saved with them.
+        """
+        self._get_df()
+        with self.lock:
+            mask = self.df["filename"].isin(hashes.keys())
+            for path in self.df.index[mask]:
+                self.edits.pop(path, None)
+            self.df = self.df.astype({"hash": object, "saved": object})
+            self.df.loc[mask, "hash"] = self.df.loc[mask, "filename"].map(hashes)
+            self.df.loc[mask, "saved"] = True
+            self._changed()
+
+    def set_duplicates(self, groups: List[List[str]]) -> None:
+        """
+        Numbers the groups of near-duplicate recordings, given as the paths of their files, in the duplicate column.
+        """
+        self._get_df()
+        with self.lock:
+            self.duplicates = {path: i for i, group in enumerate(groups, start=1) for path in group}
+            self.df["duplicate"] = pd.Series([self.duplicates.get(x) for x in self.df["path"]], self.df.index, object)
+            self._changed()
+
+    def query(
+        self,
+        session_id: str,
+        start_row: int,
+        end_row: int,
+        sort_model: Optional[List[Dict]] = None,
+        filter_model: Optional[Dict] = None,
+    ) -> Tuple[List[Dict], int]:
+        """
+        Returns a block of the sorted and filtered rows with the number of rows that pass the filters. The sorted and
+        filtered rows are kept for the next block of the same page, so scrolling through the table only slices them.
+        The rows of the pages that requested rows most recently are kept, at most max_views.
+        """
+        self._get_df()
+        key = json.dumps([sort_model, filter_model], sort_keys=True)
+        with self.lock:
+            if session_id not in self.views or self.views[session_id][0] != key:
+                df = sort_rows(df=filter_rows(df=self.df, filter_model=filter_model), sort_model=sort_model)
+                self.views[session_id] = key, df
+            self.views.move_to_end(session_id)
+            while len(self.views) > self.max_views:
+                self.views.popitem(last=False)
+            view = self.views[session_id][1]
+        return to_records(view.iloc[start_row:end_row]), len(view)
+
+    def select(self, filter_model: Optional[Dict] = None) -> List[Dict]:
+        """
+        Returns the rows that pass the filters, e.g. the rows a deck is generated from.
+        """
+        self._get_df()
+        with self.lock:
+            df = self.df
+        return to_records(filter_rows(df=df, filter_model=filter_model))
+
+
+music_table = MusicTable(max_views=VibesterConfig.table_max_views)
@@ -1,20 +1,29 @@
 import os
 import re
-import time
+import asyncio
 import hashlib
-import requests
+import datetime
 import acoustid
 import pandas as pd
 import discogs_client
 import musicbrainzngs
-from mutagen.mp3 import MP3
+from loader import catalog
 from mutagen.id3 import ID3
-from decorators import robust
+from jobs import JobContext
 from config import VibesterConfig
+from library import library_index
+from manifest import scan_manifest
 from mutagen.easyid3 import EasyID3
-from pages.play.utils import find_file
-from typing import Optional, Dict, Union
+from generator.generate import generate
+from fingerprints import fingerprint_store
+from decorators import robust, robust_async
+from concurrent.futures import as_completed
+from mutagen.mp3 import MP3, HeaderNotFoundError
+from duplicates import DuplicateIndex, decode_fingerprint
 from pages.generate.spotify_token import SpotifyTokenGenerator
+from pages.generate.musicbrainz_index import musicbrainz_index
+from pages.generate.providers import provider_loop, provider_cache, is_provider_failure
+from typing import Optional, Dict, Union, List, Iterator, Tuple, Callable, Awaitable, Any
 
 spotify_token_generator = SpotifyTokenGenerator()
 discogs_client_inst = discogs_client.Client(
@@ -58,12 +67,38 @@ def find_smallest_year(*args: Union[str, None]) -> Optional[int]:
     return min(valid_years, default=None)
 
 
+def create_music_record(filename: str, metadata: Optional[Dict[str, str]]) -> Dict:
+    """
+    Creates the row of the music table for a music file that is not in the DB yet.
+    """
+    if metadata is None:
+        metadata = dict()
+    return {
+        "filename": filename,
+        "artist": metadata.get("artist", None),
+        "title": metadata.get("title", None),
+        "year": metadata.get("year", None),
+        "genre": metadata.get("genre", None),
+        "saved": False,
+        "hash": None,
+    }
+
+
 @robust
 def get_metadata_from_file(filepath: str) -> Dict[str, str]:
     """
     Extracts the metadata embedded into a mp3 file if possible.
+    Files that are not mp3 files or have no IDv3 tags have no metadata, so they are identified by fingerprinting.
     """
-    audio = MP3(filepath, ID3=ID3)
+    no_tags = {"artist": None, "title": None, "year": None}
+    if not filepath.lower().endswith(".mp3"):
+        return no_tags
+    try:
+        audio = MP3(filepath, ID3=ID3)
+    except HeaderNotFoundError:  # No mp3 frames, e.g. another format with the mp3 extension
+        return no_tags
+    if audio.tags is None:
+        return no_tags
     metadata = {
         "artist": str(audio.tags.get("TPE1").text[0]) if "TPE1" in audio.tags else None,  # Artist
         "title": str(audio.tags.get("TIT2").text[0]) if "TIT2" in audio.tags else None,  # Title
@@ -72,25 +107,41 @@ def get_metadata_from_file(filepath: str) -> Dict[str, str]:
     return metadata
 
 
-@robust
-def get_recording_id(filepath: str) -> Optional[str]:
+async def get_recording_id(filepath: str) -> Optional[str]:
     """
     Uses acoustid to fingerprint a single music file and returns its recording ID.
+    The fingerprint of a file is calculated only once and kept in the fingerprint store.
+    Returns None if the file cannot be fingerprinted or AcoustID doesn't know it. Errors of AcoustID are raised.
     """
     api_key_acoustid = os.getenv("API_KEY_ACOUSTID")
-    results = acoustid.match(api_key_acoustid, filepath)
+    try:
+        duration, fingerprint = await asyncio.to_thread(fingerprint_store.fingerprint_file, filepath)  # Runs fpcalc
+    except acoustid.FingerprintGenerationError as e:  # Chromaprint cannot decode the file
+        print(f"Could not fingerprint {filepath}\n{e}")
+        return None
+    response = await provider_loop.call("acoustid", acoustid.lookup, api_key_acoustid, fingerprint, duration)
+    results = acoustid.parse_lookup_result(response)
     for score, recording_id, title, artist in results:
         if score > VibesterConfig.fingerprint_conf_threshold:
             return recording_id
     return None
 
 
-@robust
-def query_musicbrainz(recording_id: str) -> Dict[str, Optional[str]]:
+@provider_cache.cached("musicbrainz")
+async def query_musicbrainz(recording_id: str) -> Optional[Dict[str, Optional[str]]]:
     """
     Queries the MusicBrainz API for music recordings based on the recording ID.
+    Returns None if MusicBrainz doesn't know the recording, e.g. it was merged into another one or deleted.
+    Other errors are raised.
     """
-    result = musicbrainzngs.get_recording_by_id(recording_id, includes=["artists", "releases", "tags"])
+    try:
+        result = await provider_loop.call(
+            "musicbrainz", musicbrainzngs.get_recording_by_id, recording_id, includes=["artists", "releases", "tags"]
+        )
+    except musicbrainzngs.ResponseError as e:
+        if getattr(e.cause, "code", None) == 404:  # Cached as a "no result" answer
+            return None
+        raise
     recording = result["recording"]
 
     # Get the title of the track
@@ -128,59 +179,68 @@ def query_musicbrainz(recording_id: str) -> Dict[str, Optional[str]]:
     except (KeyError, TypeError):
         genre = ""
 
-    time.sleep(0.34)  # At most 3 requests per second
     return {"title": title, "artist": artists, "year": year, "genre": genre}
 
 
-@robust
-def query_deezer(title: str, artist: str) -> Optional[Dict[str, str]]:
+@provider_cache.cached("deezer")
+async def search_deezer(title: str, artist: str) -> Optional[int]:
     """
-    Queries the Deezer API to find the metadata of a song, including its release year.
+    Searches for a song on Deezer and returns the ID of the album of the best match.
     """
-    # Search for track
     search_url = "https://api.deezer.com/search"
     params = {"q": f"track:\"{title}\" artist:\"{artist}\"".replace("?", "")}
-    response = requests.get(search_url, params=params)
+    response = await provider_loop.request("deezer", "GET", search_url, params=params)
     response.raise_for_status()
     results = response.json()
 
     if not results["data"]:
         return None  # No results found
+    return results["data"][0]["album"]["id"]
 
-    # Extract track and album details
-    track = results["data"][0]
-    track_metadata = {
-        "artist": track["artist"]["name"],
-        "title": track["title"],
-        "year": None,
-        "album": track["album"]["title"],
-        "album_id": track["album"]["id"],
-    }
 
-    # Fetch album details for the release year
-    album_url = f"https://api.deezer.com/album/{track_metadata['album_id']}"
-    album_response = requests.get(album_url)
+@provider_cache.cached("deezer_album")
+async def query_deezer_album(album_id: int) -> Optional[str]:
+    """
+    Fetches the release year of an album from Deezer. Cached per album, since many tracks share an album.
+    """
+    album_url = f"https://api.deezer.com/album/{album_id}"
+    album_response = await provider_loop.request("deezer", "GET", album_url)
     album_response.raise_for_status()
     album_data = album_response.json()
 
-    # Add release year to the metadata
     if "release_date" in album_data:
-        track_metadata["year"] = album_data["release_date"].split("-")[0]
+        return album_data["release_date"].split("-")[0]
+    return None
 
-    return track_metadata["year"]
 
+@robust_async
+async def query_deezer(title: str, artist: str) -> Optional[str]:
+    """
+    Queries the Deezer API to find the release year of a song: the song is searched, then its album is fetched.
+    """
+    album_id = await search_deezer(title=title, artist=artist)
+    if album_id is None:
+        return None
+    return await query_deezer_album(album_id=album_id)
 
-@robust
-def query_spotify(title: str, artist: str) -> Optional[str]:
+
+@robust_async
+@provider_cache.cached("spotify")
+async def query_spotify(title: str, artist: str) -> Optional[str]:
     """
     Search for a song on Spotify.
     """
     url = "https://api.spotify.com/v1/search"
-    token = spotify_token_generator.get_token()
+    token = await asyncio.to_thread(spotify_token_generator.get_token)  # Renewed with a blocking request
     headers = {"Authorization": f"Bearer {token}"}
     params = {"q": f"track:{title} artist:{artist}", "type": "track", "limit": 1}
 
-    response = requests.get(url, headers=headers, params=params)
+    response = await provider_loop.request("spotify", "GET", url, headers=headers, params=params)
+    if response.status_code == 401:  # The token was revoked or expired early
+        spotify_token_generator.invalidate(token=token)
+        token = await asyncio.to_thread(spotify_token_generator.get_token)
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await provider_loop.request("spotify", "GET", url, headers=headers, params=params)
     response.raise_for_status()
     tracks = response.json().get("tracks", {}).get("items", [])
 
@@ -194,24 +254,39 @@ def query_spotify(title: str, artist: str) -> Optional[str]:
 def get_song_release_date(title: str, artist: str) -> Optional[str]:
     """
     Search for the release date of a song on Discogs.
+    Only the first page of the search results is read, and only the fields of the results themselves, so the search is
+    a single request that goes through the rate limiter and the timeout of the provider.
     """
     # Search for the artist and track title.
     search_results = discogs_client_inst.search(title, artist=artist, type='release')
+    search_results.per_page = VibesterConfig.discogs_max_results
+    releases = search_results.page(1)
 
     # Handle no results found.
-    if not search_results:
+    if not releases:
         print(f"No Discogs release found for '{title}' by '{artist}'.")
         return None
 
-    # Iterate through the results and find the matching release.
-    for release in search_results:
-        if release.title.lower() == title.lower() and release.artists[0].name.lower() == artist.lower():
-            return release.year
+    # Iterate through the results and find the matching release, their titles are "artist - title"
+    for release in releases:
+        release_artist, _, release_title = release.data.get("title", "").partition(" - ")
+        if release_title.lower() == title.lower() and release_artist.lower() == artist.lower():
+            if release.data.get("year"):
+                return str(release.data["year"])
 
     print(f"Could not find an exact Discogs match for '{title}' by '{artist}'.")
     return None
 
 
+@robust_async
+@provider_cache.cached("discogs")
+async def query_discogs(title: str, artist: str) -> Optional[str]:
+    """
+    Search for the release year of a song on Discogs. The Discogs client is blocking, so it runs in a thread.
+    """
+    return await provider_loop.call("discogs", get_song_release_date, title=title, artist=artist)
+
+
 @robust
 def get_artist_from_filepath(filepath: str) -> Optional[str]:
     """
@@ -237,12 +312,37 @@ def get_title_from_filepath(filepath: str) -> Optional[str]:
     return None
 
 
-@robust
-def get_metadata(filepath: str) -> Dict[str, str]:
+async def find_recording(filepath: str) -> Optional[Dict[str, Optional[str]]]:
+    """
+    Fingerprints a music file and looks up its recording, in the imported MusicBrainz dump first. Returns None if the
+    recording cannot be found. Failures of the providers are raised, as the recording may be found once they are back.
+    """
+    try:
+        recording_id = await get_recording_id(filepath=filepath)
+        if recording_id is None:
+            return None
+        recording = musicbrainz_index.get_recording(recording_id=recording_id)  # Imported MusicBrainz dump
+        if recording is None:
+            recording = await query_musicbrainz(recording_id=recording_id)
+        return recording
+    except Exception as e:
+        if is_provider_failure(error=e):
+            raise
+        print(f"Error in find_recording(filepath={filepath})\n{e}")  # A provider answered, e.g. 400 for the request
+        return None
+
+
+@robust_async
+async def get_metadata_async(filepath: str) -> Optional[Dict[str, str]]:
     """
     Creates a fingerprint from a musical track and creates its track ID.
+    The recording and the release year are looked up in the imported MusicBrainz dump first. The release year of the
+    tracks missing from it is looked up on all the configured providers at the same time.
+    Returns an empty dict if the file cannot be identified, and None if an error occurred, e.g. a provider is down.
     """
     metadata = get_metadata_from_file(filepath=filepath)  # Get metadata from IDv3 tags
+    if metadata is None:  # The file could not be read
+        return None
 
     if metadata["artist"] and metadata["title"] and metadata["year"]:  # Everything encoded in IDv3 tags
         metadata["year"] = infer_year(metadata["year"])
@@ -250,29 +350,29 @@ def get_metadata(filepath: str) -> Dict[str, str]:
         return metadata
 
     if not metadata["artist"] or not metadata["title"]:  # Tags not encoded - fingerprinting
-        recording_id = get_recording_id(filepath=filepath)
-        if recording_id:
-            metadata = query_musicbrainz(recording_id=recording_id)
+        recording = await find_recording(filepath=filepath)
+        if recording:
+            metadata = recording
         else:
             metadata["artist"] = get_artist_from_filepath(filepath)
             metadata["title"] = get_title_from_filepath(filepath)
 
     if metadata["title"] and metadata["artist"]:  # Tags found by fingerprinting - query year
-        year_mb, year_sp, year_dz, year_dc = None, None, None, None
-
+        year_mb, year_index = None, None
         if "musicbrainz" in VibesterConfig.metadata_sources:
             year_mb = metadata.get("year", None)
+            year_index = musicbrainz_index.find_year(artist=metadata["artist"], title=metadata["title"])
 
-        if "spotify" in VibesterConfig.metadata_sources:
-            year_sp = query_spotify(title=metadata["title"], artist=metadata["artist"])
-
-        if "deezer" in VibesterConfig.metadata_sources:
-            year_dz = query_deezer(title=metadata["title"], artist=metadata["artist"])
-
-        if "discogs" in VibesterConfig.metadata_sources:
-            year_dc = query_deezer(title=metadata["title"], artist=metadata["artist"])
+        if year_index:  # The earliest release known to MusicBrainz, the network is only asked on a miss
+            years = [year_index]
+        else:
+            providers = {"spotify": query_spotify, "deezer": query_deezer, "discogs": query_discogs}
+            years = await asyncio.gather(*[
+                query(title=metadata["title"], artist=metadata["artist"])
+                for source, query in providers.items() if source in VibesterConfig.metadata_sources
+            ])
 
-        year = find_smallest_year(year_mb, year_dz, year_sp, year_dc)
+        year = find_smallest_year(year_mb, *years)
 
         if year:
             metadata["year"] = year
@@ -286,6 +386,101 @@ def get_metadata(filepath: str) -> Dict[str, str]:
     return metadata
 
 
+def get_metadata(filepath: str) -> Optional[Dict[str, str]]:
+    """
+    Identifies a single music file. Returns None if the identification ran into an error.
+    """
+    return provider_loop.run(get_metadata_async(filepath=filepath))
+
+
+def iter_metadata(
+    filepaths: List[str],
+    identify: Callable[[str], Awaitable[Any]] = get_metadata_async,
+) -> Iterator[Tuple[int, Any]]:
+    """
+    Identifies several music files concurrently, at most metadata_concurrency at the same time. The number of
+    requests sent to each provider is bounded by its rate limiter. Yields the index of each file with its metadata as
+    soon as the file is identified. The lookups still running are cancelled if the caller stops iterating.
+    A file is identified by get_metadata_async unless another coroutine function is given.
+    """
+    semaphore = asyncio.Semaphore(VibesterConfig.metadata_concurrency)
+
+    async def identify_bounded(filepath: str) -> Any:
+        async with semaphore:
+            return await identify(filepath)
+
+    futures = {provider_loop.submit(identify_bounded(filepath=filepath)): i for i, filepath in enumerate(filepaths)}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def add_library_path(record: Dict, relpath: str) -> Dict:
+    """
+    Adds the path of a music file relative to the music folder and the name of its folder to its row of the music
+    table. The path identifies the row while the table is being updated.
+    """
+    parts = relpath.split("/")
+    directory = parts[-2] if len(parts) > 1 else os.path.basename(VibesterConfig.path_music)
+    return {**record, "path": relpath, "directory": directory}
+
+
+def scan_library(job: JobContext, files: List[List[str]]) -> Dict:
+    """
+    Background job of the generate page that identifies the music files which are neither in the DB nor in the scan
+    manifest, given as (filename, relative path) pairs. The row of each file is emitted as soon as it is identified,
+    and the results are saved to the scan manifest every library_scan_checkpoint files, so a scan that is stopped
+    resumes with the files that are still unidentified. Files that cannot be identified are recorded as failures and
+    tried again after manifest_failure_ttl, files that ran into an error on the next scan. Returns the number of files
+    that were identified.
+    """
+    # Files whose content hash is still valid are looked up without reading them
+    pending = []
+    for filename, relpath in files:
+        content_hash = library_index.get_content_hash(relpath=relpath, calculate=False)
+        music_metadata = scan_manifest.get(content_hash=content_hash)
+        if music_metadata is None:
+            pending.append((filename, relpath))
+        else:
+            job.emit([add_library_path(create_music_record(filename=filename, metadata=music_metadata), relpath)])
+
+    relpaths = {os.path.abspath(os.path.join(VibesterConfig.path_music, relpath)): relpath for _, relpath in pending}
+
+    @robust_async
+    async def identify(filepath: str) -> Tuple[Optional[Dict[str, str]], bool]:
+        """
+        Identifies a file unless the manifest knows its content, e.g. of a file that was renamed, moved or touched.
+        The file is hashed here rather than before the scan, so the first rows are not held up by hashing the others.
+        """
+        content_hash = await asyncio.to_thread(library_index.get_content_hash, relpaths[filepath])  # Reads the file
+        music_metadata = scan_manifest.get(content_hash=content_hash)
+        if music_metadata is not None:
+            return music_metadata, True
+        return await get_metadata_async(filepath=filepath), False
+
+    identified = 0
+    try:
+        for done, (i, result) in enumerate(iter_metadata(filepaths=list(relpaths), identify=identify), start=1):
+            filename, relpath = pending[i]
+            music_metadata, known = result if result is not None else (None, False)
+            if music_metadata is not None and not known:  # None means an error, the file is tried again next time
+                content_hash = library_index.get_content_hash(relpath=relpath)  # Hashed before it was identified
+                scan_manifest.put(content_hash=content_hash, relpath=relpath, metadata=music_metadata)
+                identified += bool(music_metadata)
+            job.emit([add_library_path(create_music_record(filename=filename, metadata=music_metadata), relpath)])
+            if done % VibesterConfig.library_scan_checkpoint == 0:
+                scan_manifest.save()
+                library_index.save()
+            job.update(progress=done / len(pending), message=f"Identified {done} of {len(pending)} new files")
+    finally:
+        scan_manifest.save()
+        library_index.save()
+    return {"files": len(files), "identified": identified}
+
+
 @robust
 def write_id3_tags(filepath: str, artist: str, title: str, year: str) -> None:
     """
@@ -337,8 +532,11 @@ def write_id3_tags_batch(df: pd.DataFrame) -> None:
             and df.loc[i, "title"] is not None
             and df.loc[i, "year"] is not None
         ):
-            filepath = find_file(root_dir=VibesterConfig.path_music, filename=df.loc[i, "filename"])
-            if not has_required_tags(filepath=filepath):
+            filepath = library_index.find(
+                filename=df.loc[i, "filename"],
+                relpath=df.loc[i, "path"] if "path" in df.columns else None,
+            )
+            if filepath is not None and not has_required_tags(filepath=filepath):
                 write_id3_tags(  # Save ID3 tags from the table to the MP3 file
                     filepath=filepath,
                     artist=df.loc[i, "artist"],
@@ -347,6 +545,86 @@ def write_id3_tags_batch(df: pd.DataFrame) -> None:
                 )
 
 
+@robust
+def get_fingerprint(filepath: str) -> Optional[str]:
+    """
+    Returns the Chromaprint fingerprint of a music file, calculating it only if its content was not fingerprinted yet.
+    """
+    _, fingerprint = fingerprint_store.fingerprint_file(filepath=filepath)
+    return fingerprint
+
+
+def find_duplicates(job: JobContext) -> Dict:
+    """
+    Background job of the duplicates button on the generate page. Finds the groups of near-duplicate recordings in
+    the library, e.g. album and single versions, and writes them to a csv report. Files that were identified by
+    fingerprinting reuse their fingerprint, the others are fingerprinted first. Returns the name of the report and
+    the groups as the relative paths of their files with their similarity to the first file of the group.
+    """
+    files = [relpath for filename, relpath in library_index.items() if is_music_file(filename)]
+    index = DuplicateIndex(num_perm=VibesterConfig.duplicate_num_perm, bands=VibesterConfig.duplicate_bands)
+    try:
+        for done, relpath in enumerate(files, start=1):
+            fingerprint = get_fingerprint(filepath=os.path.join(VibesterConfig.path_music, relpath))
+            if fingerprint:
+                index.add(key=relpath, fingerprint=decode_fingerprint(fingerprint=fingerprint))
+            job.update(progress=0.9 * done / len(files), message=f"Fingerprinted {done} of {len(files)} files")
+    finally:
+        library_index.save()  # Content hashes calculated for the fingerprints
+
+    job.update(progress=0.9, message="Comparing the fingerprints")
+    groups = index.find_duplicates(
+        min_similarity=VibesterConfig.duplicate_min_similarity,
+        min_overlap=VibesterConfig.duplicate_min_overlap,
+    )
+
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    output_filename = f"duplicates_{timestamp}.csv"
+    report = pd.DataFrame(
+        [
+            {"group": i, "path": relpath, "similarity": round(similarity, 3)}
+            for i, group in enumerate(groups, start=1) for relpath, similarity in group
+        ],
+        columns=["group", "path", "similarity"],
+    )
+    report.to_csv(os.path.join(VibesterConfig.path_output, output_filename), index=False)
+    return {"filename": output_filename, "groups": [[relpath for relpath, _ in group] for group in groups]}
+
+
+def generate_deck(job: JobContext, row_data_virtual: List[Dict]) -> Dict:
+    """
+    Background job of the run button on the generate page. Renders the rows currently shown in the music table into
+    a pdf file with QR codes, marks them as saved in the DB and writes their ID3 tags. The DB is only written once the
+    pdf is ready, so a cancelled job leaves it untouched, and only the rows of the deck are written, so the job never
+    overwrites the rows other decks saved in the meantime. Returns the name of the pdf file and the hashes of the cards.
+    """
+    # Set up the dataframe
+    df_virtual = pd.DataFrame(row_data_virtual)
+    df_virtual.drop_duplicates(inplace=True)
+    df_virtual.dropna(inplace=True, subset=["filename", "artist", "title", "year"])  # Rows must have these tags
+    df_virtual["hash"] = [
+        calculate_hash(f"{artist}{title}{year}") for artist, title, year in zip(
+            df_virtual["artist"], df_virtual["title"], df_virtual["year"]
+        )
+    ]
+
+    # Send virtual files to generator, the rendering is most of the work
+    directories = sorted([re.sub(r'[^a-zA-Z0-9]', '', x) for x in df_virtual["directory"].unique()])
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    output_filename = f"output_{'_'.join(directories)}_{timestamp}.pdf"
+    job.update(progress=0.05, message=f"Rendering {len(df_virtual)} cards")
+    generate(df=df_virtual, filename=output_filename, progress=lambda ratio: job.update(progress=0.05 + 0.85 * ratio))
+
+    # Save the rows of the deck to the catalog
+    job.update(progress=0.9, message="Saving the records")
+    df_virtual["saved"] = True
+    catalog.save_tracks(records=df_virtual.to_dict("records"))
+
+    job.update(progress=0.95, message="Writing ID3 tags")
+    write_id3_tags_batch(df=df_virtual)
+    return {"filename": output_filename, "hashes": dict(zip(df_virtual["filename"], df_virtual["hash"]))}
+
+
 if __name__ == "__main__":
     # This can be used as an automtic tagger
     # Usage: choose a target folder, and it will be traversed recursively. Music inside the folder will be tagged if
@@ -1,28 +1,23 @@
-import cv2
-import base64
-import numpy as np
-import pandas as pd
-from loader import load_db
-from .utils import find_file
+from loader import catalog
+from typing import Dict, Tuple
 from config import VibesterConfig
-from typing import List, Dict, Tuple
 from dash import Dash, Input, Output, State, callback, no_update, ctx
 
 
 def register_callbacks(app: Dash) -> None:
     @callback(
-        Output({"name": "music_store", "type": "store", "page": "play"}, "data"),
+        Output({"name": "catalog_store", "type": "store", "page": "play"}, "data"),
         Input({"name": "url", "type": "location", "page": "play"}, "pathname"),
     )
-    def load_music_store(pathname: str) -> List[Dict]:
+    def load_catalog_version(pathname: str) -> Dict:
         """
-        Loads the music database from the local disk into a store component.
+        Loads the version of the music catalog into a store component. The catalog itself stays on the server, the
+        version only tells the page when to drop the cards it has already resolved.
         """
         if pathname != "/play":
             return no_update
 
-        df_db = load_db()  # Reads DB pickle file from the disk or creates it if it does not exist
-        return df_db.to_dict("records")
+        return {"version": catalog.get_version()}
 
     app.clientside_callback(
         """
@@ -71,99 +66,196 @@ def register_callbacks(app: Dash) -> None:
 
     app.clientside_callback(
         """
-        function(n_intervals) {
+        function(n_intervals, config, catalog, interval) {
             const video = document.getElementById('play_video');
-            const store = document.getElementById('captured_frame');
+            const state = window.vibesterScan = window.vibesterScan || {
+                pending: 0,
+                version: null,
+                tracks: {},
+                session: window.crypto && crypto.randomUUID ? crypto.randomUUID() : String(Math.random())
+            };
+            const noUpdate = window.dash_clientside.no_update;
 
-            if (video && video.style.display !== "none" && video.srcObject) {
-                const canvas = document.createElement('canvas');
-                const context = canvas.getContext('2d');
+            // Cards resolved in the browser are only valid for the catalog version they were resolved against
+            const syncCatalog = (version) => {
+                if (version && version !== state.version) {
+                    state.version = version;
+                    state.tracks = {};
+                }
+            };
+            if (catalog && catalog.version !== state.pageVersion) {  // The page (re)loaded the catalog version
+                state.pageVersion = catalog.version;
+                syncCatalog(catalog.version);
+            }
+
+            if (!video || video.style.display === "none" || !video.srcObject || !video.videoWidth || document.hidden) {
+                return [noUpdate, noUpdate];  // Nothing to capture
+            }
+
+            // Turns the response of the scan or resolve endpoint into the matched track (null if nothing matched)
+            // and whether a code was seen that could not be decoded yet
+            const toResult = (response) => {
+                if (response.headers.get('X-Scan-Superseded') === '1') {
+                    return {superseded: true};  // A newer frame of this page replaced this one on the server
+                }
+                syncCatalog(response.headers.get('X-Catalog-Version'));
+                const candidate = response.headers.get('X-Scan-Candidate') === '1';
+                return (response.status === 200 ? response.json() : Promise.resolve(null))
+                    .then((track) => ({track: track, candidate: candidate}));
+            };
+            const noResult = {track: null, candidate: false};
+
+            // Adapts the sampling interval: back off while nothing QR-like is in view and sample faster for a short
+            // burst after a code was seen that could not be decoded yet
+            const schedule = (result) => {
+                if (result.superseded) {
+                    return [noUpdate, noUpdate];
+                }
+                if (result.track || result.candidate) {
+                    state.idle = 0;
+                    state.burst = result.track ? 0 : config.burst_frames;  // The sampling pauses during playback
+                } else {
+                    state.idle = (state.idle || 0) + 1;
+                    state.burst = Math.max(0, (state.burst || 0) - 1);
+                }
+                const backoff = Math.pow(2, Math.max(0, state.idle - config.idle_frames));
+                const next = state.burst > 0
+                    ? config.interval_burst
+                    : Math.min(config.interval_max, config.interval * backoff);
+                return [
+                    result.track ? {...result.track, scanned: Date.now()} : noUpdate,
+                    next !== interval ? next : noUpdate
+                ];
+            };
 
-                // Set canvas size to match video dimensions
-                canvas.width = video.videoWidth;
-                canvas.height = video.videoHeight;
+            // Resolves a hash decoded in the browser, each hash is only sent to the server once per catalog version
+            const resolveHash = (cardHash) => (cardHash in state.tracks
+                ? Promise.resolve(state.tracks[cardHash])
+                : fetch('/resolve/' + encodeURIComponent(cardHash), {credentials: 'same-origin'})
+                    .then(toResult)
+                    .then(({track}) => {
+                        state.tracks[cardHash] = track;
+                        return track;
+                    })
+            ).then((track) => ({track: track, candidate: false}));
 
-                // Draw the current video frame onto the canvas
-                context.drawImage(video, 0, 0, canvas.width, canvas.height);
+            // Server-side decoding: center-crop a square of the frame, downscale it and post it as a compact JPEG
+            const scanOnServer = () => new Promise((resolve) => {
+                const side = Math.min(video.videoWidth, video.videoHeight) * config.crop;
+                const scale = Math.min(1, config.size / side);
+                const canvas = state.canvas = state.canvas || document.createElement('canvas');
+                canvas.width = canvas.height = Math.round(side * scale);
+                canvas.getContext('2d').drawImage(
+                    video,
+                    (video.videoWidth - side) / 2, (video.videoHeight - side) / 2, side, side,
+                    0, 0, canvas.width, canvas.height
+                );
+                canvas.toBlob((blob) => {
+                    if (!blob) {
+                        resolve(noResult);
+                        return;
+                    }
+                    resolve(fetch('/scan', {
+                        method: 'POST',
+                        body: blob,
+                        headers: {'Content-Type': 'image/jpeg', 'X-Scan-Session': state.session},
+                        credentials: 'same-origin'
+                    }).then(toResult));
+                }, 'image/jpeg', config.quality);
+            });
 
-                // Convert canvas content to base64-encoded image (data URL)
-                const frameData = canvas.toDataURL('image/png');
+            // Browser-side decoding: the worker decodes the frame and the server only resolves the decoded hash
+            const scanInBrowser = () => createImageBitmap(video).then((bitmap) => new Promise((resolve) => {
+                state.worker.onmessage = (event) => resolve(event.data);
+                state.worker.onerror = () => resolve({unsupported: true});  // The worker could not be started
+                state.worker.postMessage({bitmap: bitmap, crop: config.crop, size: config.size}, [bitmap]);
+            })).then((result) => {
+                if (result.unsupported) {
+                    console.warn("QR decoding is not supported by this browser, falling back to the server.");
+                    state.worker.terminate();
+                    state.worker = null;
+                    return scanOnServer();
+                }
+                if (!result.data) {
+                    return noResult;
+                }
+                return resolveHash(result.data);
+            });
 
-                return frameData;  // Return the frame data to store
+            if (config.mode === 'browser' && state.worker === undefined) {
+                state.worker = window.Worker && window.OffscreenCanvas && window.createImageBitmap
+                    ? new Worker('/assets/qr.worker.js')
+                    : null;
             }
-            return null;  // No frame captured
+
+            // The worker decodes one frame at a time. The server queues at most one frame per page next to the one it
+            // is decoding, a newer frame supersedes the queued one so the server never works on stale frames.
+            const inBrowser = config.mode === 'browser' && state.worker;
+            if (state.pending >= (inBrowser ? 1 : 2)) {
+                return [noUpdate, noUpdate];
+            }
+
+            state.pending += 1;
+            return (inBrowser ? scanInBrowser() : scanOnServer())
+                .catch((err) => {
+                    console.error("Frame scan error:", err);
+                    return noResult;
+                })
+                .then(schedule)
+                .finally(() => { state.pending -= 1; });
         }
         """,
-        Output({"name": "frame_store", "type": "store", "page": "play"}, "data"),
-        Input({"name": "sample", "type": "interval", "page": "play"}, "n_intervals")
+        Output({"name": "track_store", "type": "store", "page": "play"}, "data"),
+        Output({"name": "sample", "type": "interval", "page": "play"}, "interval"),
+        Input({"name": "sample", "type": "interval", "page": "play"}, "n_intervals"),
+        State({"name": "scan_config", "type": "store", "page": "play"}, "data"),
+        State({"name": "catalog_store", "type": "store", "page": "play"}, "data"),
+        State({"name": "sample", "type": "interval", "page": "play"}, "interval")
     )
 
     @callback(
         Output("play_video", "style"),
         Output({"name": "music", "type": "audio", "page": "play"}, "src"),
         Output({"name": "stop_music", "type": "button", "page": "play"}, "style"),
-        Input({"name": "frame_store", "type": "store", "page": "play"}, "data"),
+        Output({"name": "sample", "type": "interval", "page": "play"}, "disabled"),
+        Input({"name": "track_store", "type": "store", "page": "play"}, "data"),
         Input({"name": "stop_music", "type": "button", "page": "play"}, "n_clicks"),
         State({"name": "url", "type": "location", "page": "play"}, "pathname"),
-        State({"name": "music_store", "type": "store", "page": "play"}, "data")
     )
-    def scan_image(
-        image_b64: str,
+    def play_track(
+        track: Dict,
         n_clicks: int,
         pathname: str,
-        music_store_data: List[Dict]
-    ) -> Tuple[Dict, str, Dict]:
+    ) -> Tuple[Dict, str, Dict, bool]:
         """
-        Scans webcamera image for QR codes. The camera image is provided as a base64 encoded string.
+        Starts playing the track matched by the scan endpoint or stops the music when the stop button is pressed.
+        The sampling of the webcamera is paused while the music is playing.
         """
         if pathname != "/play":
-            return no_update, no_update, no_update
-
-        if "frame_store" in str(ctx.triggered_id):
-            if not image_b64 or pathname != "/play" or not music_store_data or len(music_store_data) == 0:
-                return no_update, no_update, no_update
-
-            # Decode the Base64 string into an image
-            try:
-                # Extract the Base64 portion of the string (remove "data:image/png;base64,")
-                image_data = base64.b64decode(image_b64.split(",")[1])
-                # Convert to a numpy array and decode into an image
-                nparr = np.frombuffer(image_data, np.uint8)
-                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                # Scan the image_b64 for QR codes
-                detector = cv2.QRCodeDetector()
-                data, bbox, _ = detector.detectAndDecode(image)
-
-                # If there is a QR code decode and print it
-                if data:
-                    # If a QR code is detected, check it against music_store_data
-                    df_music = pd.DataFrame(music_store_data)
-                    matched_items = df_music.query(f"hash == '{data}'")
-                    if len(matched_items) > 0:
-                        # If a match is found, start playing music
-                        filename = matched_items.iloc[0, :]["filename"]
-                        # Find which folder the music is in
-                        filepath = find_file(root_dir=VibesterConfig.path_music, filename=filename)
-                        filepath = filepath.lstrip("data/")  # Strip this because of the music serving endpoint
-                        return (
-                            {"display": "none"},
-                            filepath,
-                            VibesterConfig.default_style_button_big_gif,
-                        )
-
-                return no_update, no_update, no_update
-
-            except Exception as e:
-                print(e)
+            return no_update, no_update, no_update, no_update
+
+        if "track_store" in str(ctx.triggered_id):
+            if not track or not track.get("src"):
+                return no_update, no_update, no_update, no_update
+
+            # If a match is found, hide the webcam video, start playing music and pause the sampling
+            return (
+                {"display": "none"},
+                track["src"],
+                VibesterConfig.default_style_button_big_gif,
+                True,
+            )
 
         elif "stop_music" in str(ctx.triggered_id):
-            if not n_clicks or pathname != "/play" or not music_store_data or len(music_store_data) == 0:
-                return no_update, no_update, no_update
-
-            else:
-                # Show the webcam video, hide the button and the audio component
-                return (
-                    VibesterConfig.default_style_webcam_video,
-                    "",
-                    {"display": "none"},
-                )
+            if not n_clicks:
+                return no_update, no_update, no_update, no_update
+
+            # Show the webcam video, hide the button and the audio component and resume the sampling
+            return (
+                VibesterConfig.default_style_webcam_video,
+                "",
+                {"display": "none"},
+                False,
+            )
+
+        return no_update, no_update, no_update, no_update
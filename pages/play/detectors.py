@@ -0,0 +1,139 @@
+import os
+import cv2
+import numpy as np
+from config import VibesterConfig
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple, List
+
+
+def crop_around(image: np.ndarray, bbox: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Crops the region around a bounding box out of an image, extended by a margin relative to the size of the box.
+    Returns the crop and the offset of its top left corner.
+    """
+    margin = VibesterConfig.scan_roi_margin * (bbox.max(axis=0) - bbox.min(axis=0))
+    x0, y0 = np.maximum(bbox.min(axis=0) - margin, 0).astype(int)
+    x1, y1 = np.minimum(bbox.max(axis=0) + margin, image.shape[::-1]).astype(int)
+    return image[y0:y1, x0:x1], (x0, y0)
+
+
+class QRDetector(ABC):
+    """
+    Base class of the QR code detector backends. A backend is created once per process and reused for every frame.
+    The constructor raises if the backend is not available in the deployment, e.g. its library or models are missing.
+    """
+    name = ""
+    pyramid = False  # Whether locating the code on a downscaled frame first pays off for this backend
+
+    @abstractmethod
+    def detect_and_decode(self, image: np.ndarray) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        Finds and decodes a QR code in a grayscale image. Returns the content of the code and its corners as a
+        4x2 array, either of them can be None.
+        """
+
+    def locate(self, image: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Finds a QR code without decoding it and returns its corners.
+        """
+        return self.detect_and_decode(image=image)[1]
+
+    def decode_at(self, image: np.ndarray, bbox: np.ndarray) -> Optional[str]:
+        """
+        Decodes the QR code at a known location of an image.
+        """
+        crop, _ = crop_around(image=image, bbox=bbox)
+        return self.detect_and_decode(image=crop)[0]
+
+
+class OpenCVDetector(QRDetector):
+    """
+    The classic QR code detector of OpenCV. Fast, but sensitive to blur and small codes.
+    """
+    name = "opencv"
+    pyramid = True
+
+    def __init__(self):
+        self.detector = cv2.QRCodeDetector()
+
+    def detect_and_decode(self, image: np.ndarray) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        data, bbox, _ = self.detector.detectAndDecode(image)
+        return data or None, bbox.reshape(-1, 2) if bbox is not None else None
+
+    def locate(self, image: np.ndarray) -> Optional[np.ndarray]:
+        found, bbox = self.detector.detect(image)
+        return bbox.reshape(-1, 2) if found and bbox is not None else None
+
+    def decode_at(self, image: np.ndarray, bbox: np.ndarray) -> Optional[str]:
+        data, _ = self.detector.decode(image, bbox.reshape(1, -1, 2))
+        return data or None
+
+
+class WeChatDetector(QRDetector):
+    """
+    The CNN based QR code detector contributed to OpenCV by WeChat. Much more robust on blurry and small codes, but
+    slower. Needs the opencv-contrib package and the detector and super resolution models in the models folder.
+    """
+    name = "wechat"
+    model_files = ["detect.prototxt", "detect.caffemodel", "sr.prototxt", "sr.caffemodel"]
+
+    def __init__(self, model_dir: str):
+        if not hasattr(cv2, "wechat_qrcode_WeChatQRCode"):
+            raise RuntimeError("The WeChat QR code detector needs the opencv-contrib package")
+        paths = [os.path.join(model_dir, filename) for filename in self.model_files]
+        missing = [path for path in paths if not os.path.isfile(path)]
+        if missing:
+            raise RuntimeError(f"The WeChat QR code models are missing: {', '.join(missing)}")
+        self.detector = cv2.wechat_qrcode_WeChatQRCode(*paths)
+
+    def detect_and_decode(self, image: np.ndarray) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        texts, points = self.detector.detectAndDecode(image)
+        if not points:
+            return None, None
+        return texts[0] or None, np.asarray(points[0], dtype=np.float32).reshape(-1, 2)
+
+
+class ZbarDetector(QRDetector):
+    """
+    The zbar barcode reader through pyzbar. Decodes only, so codes are located and decoded in one pass.
+    Needs the zbar shared library on the system.
+    """
+    name = "zbar"
+
+    def __init__(self):
+        from pyzbar import pyzbar  # Fails at import time if the zbar shared library is missing
+        self.pyzbar = pyzbar
+
+    def detect_and_decode(self, image: np.ndarray) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        results = self.pyzbar.decode(image, symbols=[self.pyzbar.ZBarSymbol.QRCODE])
+        if not results:
+            return None, None
+        polygon = np.asarray(results[0].polygon, dtype=np.float32)
+        bbox = cv2.boxPoints(cv2.minAreaRect(polygon))  # The polygon can have more than 4 points
+        return results[0].data.decode("utf-8", errors="replace") or None, bbox
+
+
+detector_backends = {
+    "opencv": OpenCVDetector,
+    "wechat": lambda: WeChatDetector(model_dir=VibesterConfig.path_models),
+    "zbar": ZbarDetector,
+}
+detectors: Optional[List[QRDetector]] = None  # Created on the first frame of each worker process
+
+
+def get_detectors() -> List[QRDetector]:
+    """
+    Returns the detector backends configured for the scanner that are available in this deployment, in the order of
+    preference. Unavailable backends are skipped, and the classic OpenCV detector is used if none is left.
+    """
+    global detectors
+    if detectors is None:
+        available = []
+        for name in VibesterConfig.scan_detectors:
+            try:
+                available.append(detector_backends[name]())
+            except Exception as e:
+                print(f"QR detector backend {name} is not available, skipping it\n{e}")
+        detectors = available or [OpenCVDetector()]
+        print(f"QR detector backends: {', '.join(detector.name for detector in detectors)}")
+    return detectors
@@ -67,9 +67,26 @@ def get_layout() -> html.Div:
                         ]
                     ),
                     dcc.Location(id={"name": "url", "type": "location", "page": "play"}, refresh=False),
-                    dcc.Interval(id={"name": "sample", "type": "interval", "page": "play"}, interval=1000),
-                    dcc.Store(id={"name": "music_store", "type": "store", "page": "play"}, data=[]),
-                    dcc.Store(id={"name": "frame_store", "type": "store", "page": "play"}, data=[]),
+                    dcc.Interval(
+                        id={"name": "sample", "type": "interval", "page": "play"},
+                        interval=VibesterConfig.scan_interval
+                    ),
+                    dcc.Store(id={"name": "catalog_store", "type": "store", "page": "play"}, data={}),
+                    dcc.Store(id={"name": "track_store", "type": "store", "page": "play"}, data={}),
+                    dcc.Store(
+                        id={"name": "scan_config", "type": "store", "page": "play"},
+                        data={
+                            "size": VibesterConfig.scan_frame_size,
+                            "crop": VibesterConfig.scan_frame_crop,
+                            "quality": VibesterConfig.scan_jpeg_quality,
+                            "mode": VibesterConfig.scan_mode,
+                            "interval": VibesterConfig.scan_interval,
+                            "interval_max": VibesterConfig.scan_interval_max,
+                            "interval_burst": VibesterConfig.scan_interval_burst,
+                            "idle_frames": VibesterConfig.scan_idle_frames,
+                            "burst_frames": VibesterConfig.scan_burst_frames,
+                        }
+                    ),
                     dcc.Store(id={"name": "dummy", "type": "store", "page": "play"}, data=[]),
                 ]
             )
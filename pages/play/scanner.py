@@ -0,0 +1,201 @@
+import threading
+import numpy as np
+import multiprocessing
+from config import VibesterConfig
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from pages.play.utils import decode_frame, scan_frame, frame_signature
+
+
+class ScanBusy(Exception):
+    """
+    Raised when the scanner is saturated and a frame is turned away.
+    """
+
+
+class ScanSuperseded(Exception):
+    """
+    Raised when a newer frame from the same session replaced a frame that was still waiting for a worker.
+    """
+
+
+def scan_job(
+    frame: bytes,
+    width: Optional[int],
+    height: Optional[int],
+    roi: Optional[List] = None,
+) -> Tuple[Optional[str], Optional[List]]:
+    """
+    Decodes and scans a single frame. Runs inside a worker process, so the result is returned as plain Python types.
+    """
+    image = decode_frame(frame=frame, width=width, height=height)
+    if image is None:
+        raise ValueError("The frame could not be decoded")
+    data, bbox = scan_frame(image=image, roi=roi)
+    return data, bbox.tolist() if bbox is not None else None
+
+
+class FrameCache:
+    """
+    Remembers the signature and the scan result of the last frame decoded for each session, so a frame that is
+    indistinguishable from the previous one (e.g. a phone lying still with nothing in view) reuses its result instead
+    of being decoded. Only results where no QR code was found are reused: the small signature can't tell the contents
+    of two codes apart, nor a sharp code from a blurry one, so frames with a code are always decoded again, starting
+    at the location of the code in the last frame. Only the most recently active sessions are kept.
+    """
+    def __init__(self, threshold: float, max_sessions: int):
+        self.threshold = threshold
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.frames: OrderedDict[str, Tuple[np.ndarray, Tuple[Optional[str], Optional[List]]]] = OrderedDict()
+
+    def get(self, session_id: str, signature: np.ndarray) -> Optional[Tuple[Optional[str], Optional[List]]]:
+        """
+        Returns the result of the last frame of the session if the new frame is a repeat of it and no QR code was
+        found in the last frame.
+        """
+        with self.lock:
+            cached = self.frames.get(session_id)
+            if cached is None or cached[0].shape != signature.shape:
+                return None
+            self.frames.move_to_end(session_id)
+            if cached[1] != (None, None):  # A code was found, which may have been replaced or brought into focus
+                return None
+            if float(np.abs(cached[0] - signature).mean()) > self.threshold:
+                return None
+            return cached[1]
+
+    def get_bbox(self, session_id: str) -> Optional[List]:
+        """
+        Returns the bounding box of the QR code found in the last frame decoded for a session, if there was one.
+        """
+        with self.lock:
+            cached = self.frames.get(session_id)
+            return cached[1][1] if cached is not None else None
+
+    def put(self, session_id: str, signature: np.ndarray, result: Tuple[Optional[str], Optional[List]]) -> None:
+        """
+        Stores the signature and the result of the frame last decoded for a session.
+        """
+        with self.lock:
+            self.frames[session_id] = (signature, result)
+            self.frames.move_to_end(session_id)
+            while len(self.frames) > self.max_sessions:
+                self.frames.popitem(last=False)
+
+
+class ScanPool:
+    """
+    Bounded pool of worker processes that decode the frames of the play page.
+    At most max_workers frames are decoded at the same time, which is the CPU ceiling of the scanner. Frames wait for
+    a free worker in the request thread, where a newer frame from the same session supersedes the waiting one and
+    frames are turned away once max_pending frames are waiting. Repeated frames without a code are answered from the
+    frame cache.
+    """
+    def __init__(self, max_workers: int, max_pending: int, timeout: float, frame_cache: FrameCache):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.frame_cache = frame_cache
+        self.executor: Optional[ProcessPoolExecutor] = None  # Started on the first frame
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting: Dict[str, threading.Event] = dict()  # session -> event that is set when superseded
+
+    def _acquire(self, session_id: str) -> None:
+        """
+        Waits until a worker is free for the frame of a session. Raises ScanSuperseded if a newer frame of the same
+        session arrives in the meantime and ScanBusy if the pool is saturated.
+        """
+        with self.condition:
+            previous = self.waiting.get(session_id)
+            if previous is not None:
+                previous.set()  # The older frame of this session is dropped
+            elif len(self.waiting) >= self.max_pending:
+                raise ScanBusy()
+
+            superseded = threading.Event()
+            self.waiting[session_id] = superseded
+            self.condition.notify_all()
+            try:
+                ready = self.condition.wait_for(
+                    lambda: superseded.is_set() or self.active < self.max_workers,
+                    timeout=self.timeout,
+                )
+                if superseded.is_set():
+                    raise ScanSuperseded()
+                if not ready:
+                    raise ScanBusy()
+                self.active += 1
+            finally:
+                if self.waiting.get(session_id) is superseded:
+                    del self.waiting[session_id]
+
+    def _release(self) -> None:
+        """
+        Frees a worker and wakes up the frames waiting for one. Called when the frame of the worker is done, which can
+        be after the request gave up on it.
+        """
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def scan(
+        self,
+        session_id: str,
+        frame: bytes,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+    ) -> Tuple[Optional[str], Optional[List]]:
+        """
+        Decodes and scans a frame in a worker process. Returns the content and the bounding box of the QR code.
+        If the frame is a repeat of the last frame decoded for the session and that frame had no QR code in view, the
+        empty result of that frame is returned.
+        """
+        signature = frame_signature(frame=frame, width=width, height=height)
+        if signature is None:
+            raise ValueError("The frame could not be decoded")
+        cached = self.frame_cache.get(session_id=session_id, signature=signature)
+        if cached is not None:
+            return cached
+
+        self._acquire(session_id=session_id)
+        submitted = False
+        try:
+            with self.condition:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(  # Not forked from the threads of the server, see JobRunner
+                        max_workers=self.max_workers,
+                        mp_context=multiprocessing.get_context("forkserver"),
+                    )
+            roi = self.frame_cache.get_bbox(session_id=session_id)  # Where the code was in the last frame
+            future = self.executor.submit(scan_job, frame, width, height, roi)
+            future.add_done_callback(lambda _: self._release())  # The worker stays busy until the frame is done
+            submitted = True
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()  # Only drops the frame if it has not started, a frame being decoded keeps its worker
+            raise ScanBusy()
+        except BrokenProcessPool:
+            with self.condition:
+                self.executor = None  # A worker died, a new pool is started for the next frame
+            raise
+        finally:
+            if not submitted:
+                self._release()
+
+        self.frame_cache.put(session_id=session_id, signature=signature, result=result)
+        return result
+
+
+scan_pool = ScanPool(
+    max_workers=VibesterConfig.scan_workers,
+    max_pending=VibesterConfig.scan_max_pending,
+    timeout=VibesterConfig.scan_timeout,
+    frame_cache=FrameCache(
+        threshold=VibesterConfig.scan_dedup_threshold,
+        max_sessions=VibesterConfig.scan_dedup_sessions,
+    ),
+)
@@ -1,12 +1,118 @@
 import os
-from typing import Optional
+import cv2
+import numpy as np
+from loader import catalog
+from urllib.parse import quote
+from library import library_index
+from config import VibesterConfig
+from typing import Optional, Tuple
+from utils.renditions import rendition_cache
+from pages.play.detectors import get_detectors, crop_around
 
 
-def find_file(root_dir: str, filename: str, ) -> Optional[str]:
+def decode_frame(frame: bytes, width: int = None, height: int = None) -> Optional[np.ndarray]:
     """
-    Search for a file by name in the specified root folder.
+    Decodes a single camera frame sent by the play page into a grayscale image.
+    If the width and height are given the frame is treated as raw 8-bit grayscale pixels, otherwise it is decoded as
+    a compressed image (JPEG, PNG, WebP).
     """
-    for dirpath, _, filenames in os.walk(root_dir):  # Traverse the directory tree
-        if filename in filenames:
-            return str(os.path.join(dirpath, filename)).replace("\\", "/")
-    return None
+    nparr = np.frombuffer(frame, np.uint8)
+    if width and height:
+        if nparr.size != width * height:
+            return None
+        return nparr.reshape((height, width))
+    return cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+
+
+def frame_signature(frame: bytes, width: int = None, height: int = None) -> Optional[np.ndarray]:
+    """
+    Computes a perceptual signature of a camera frame: its luminance downscaled to a small square with the mean
+    brightness removed, so frames that only differ in noise or exposure have nearly identical signatures.
+    Compressed frames are decoded at a reduced scale, which is much cheaper than a full decode.
+    """
+    if width and height:
+        image = decode_frame(frame=frame, width=width, height=height)
+    else:
+        image = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None or image.size == 0:
+        return None
+
+    size = VibesterConfig.scan_dedup_size
+    signature = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    return signature - signature.mean()
+
+
+def scan_frame(image: np.ndarray, roi: Optional[np.ndarray] = None) -> Tuple[Optional[str], Optional[np.ndarray]]:
+    """
+    Scans a decoded grayscale camera frame for a QR code. Returns the content of the code if it could be decoded and
+    the bounding box of the code if one was found, which can be the case even if it could not be decoded.
+    Searching the full frame is the last resort. The code is first looked for in the region where it was in the
+    previous frame of the session (roi), then located on the downscaled levels of the image pyramid and decoded at
+    full resolution at the location found. The preferred detector backend does all of this, the other backends only
+    retry the full frame if the fallback is enabled.
+    """
+    detectors = get_detectors()
+    detector = detectors[0]
+    located = None
+
+    if roi is not None:
+        crop, offset = crop_around(image=image, bbox=np.asarray(roi, dtype=np.float32).reshape(-1, 2))
+        if crop.size < 0.8 * image.size:  # Otherwise the full frame is just as cheap
+            data, bbox = detector.detect_and_decode(image=crop)
+            if bbox is not None:
+                located = bbox + offset
+            if data:
+                return data, located
+
+    for level in VibesterConfig.scan_pyramid if detector.pyramid else []:
+        scale = level / max(image.shape)
+        if scale > 0.75:  # Not much smaller than the frame itself
+            continue
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        bbox = detector.locate(image=small)
+        if bbox is not None:
+            bbox = bbox / scale
+            data = detector.decode_at(image=image, bbox=bbox)
+            if data:
+                return data, bbox
+            located = bbox if located is None else located
+            break
+
+    data, bbox = detector.detect_and_decode(image=image)
+    located = bbox if bbox is not None else located
+    if not data and VibesterConfig.scan_detector_fallback:
+        for fallback in detectors[1:]:
+            data, bbox = fallback.detect_and_decode(image=image)
+            if data:
+                return data, bbox
+    return data, located
+
+
+def find_track(card_hash: str) -> Optional[str]:
+    """
+    Looks up the track printed on a card by its hash. Returns the source of the track the music serving endpoint
+    expects, which is the path of the file relative to the music folder prefixed by "music/", see get_music_source.
+    """
+    track = catalog.get_track(card_hash=card_hash)
+    if track is None:
+        return None
+
+    filepath = library_index.find(filename=track["filename"], relpath=track["path"])
+    if filepath is None:
+        return None
+    return get_music_source(relpath=os.path.relpath(filepath, VibesterConfig.path_music).replace("\\", "/"))
+
+
+def get_music_source(relpath: str, rendition: Optional[str] = VibesterConfig.default_rendition) -> str:
+    """
+    Returns the source of a music file the music serving endpoint expects: the address of the rendition, versioned by
+    the content hash of the file, once the rendition is ready, and the address of the original until then. What is
+    behind an address never changes, so players can request byte ranges of what they play at any time.
+    """
+    source = f"music/{quote(relpath)}"
+    if rendition in VibesterConfig.renditions:
+        path = os.path.join(VibesterConfig.path_music, relpath)
+        content_hash = library_index.get_content_hash(relpath=relpath)
+        if content_hash is not None and rendition_cache.get(filepath=path, content_hash=content_hash, name=rendition):
+            return f"{source}?rendition={rendition}&v={content_hash}"
+    return source
@@ -0,0 +1,119 @@
+import os
+import mutagen
+import threading
+from decorators import robust
+from pydub import AudioSegment
+from config import VibesterConfig
+from typing import Optional, Dict, Set
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RenditionCache:
+    """
+    Cache of compact versions of the music files made for streaming to phones, e.g. low-bitrate AAC copies of the
+    tracks and short preview clips. Renditions are keyed by the content hash of the original file, so renaming or
+    moving a file keeps its renditions. A missing rendition is transcoded in the background the first time it is
+    requested, and the original is served until it is ready.
+    """
+    def __init__(self, root_dir: str, specs: Dict[str, Dict], max_workers: int):
+        self.root_dir = root_dir
+        self.specs = specs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)  # Transcoding runs in ffmpeg processes
+        self.lock = threading.Lock()
+        self.building: Set[str] = set()
+        self.failed: Set[str] = set()  # Renditions that could not be built, they are not retried until a restart
+
+    def get_path(self, content_hash: str, name: str) -> str:
+        """
+        Returns the path of a rendition in the cache.
+        """
+        return os.path.join(self.root_dir, name, f"{content_hash}{self.specs[name]['extension']}")
+
+    def is_worthwhile(self, filepath: str, name: str) -> bool:
+        """
+        Decides if a rendition would be meaningfully smaller than the original. Full-length renditions of files that
+        already have a low bitrate would only cost quality.
+        """
+        spec = self.specs[name]
+        if spec["duration"]:
+            return True
+        audio = mutagen.File(filepath)
+        bitrate = getattr(audio.info, "bitrate", 0) // 1000 if audio is not None else 0
+        return not bitrate or bitrate > 1.25 * spec["bitrate"]
+
+    @robust
+    def build(self, filepath: str, content_hash: str, name: str) -> Optional[str]:
+        """
+        Transcodes a single rendition of a music file into the cache and returns its path.
+        If the rendition is not worth making, a marker file is left so the original is served without checking again.
+        """
+        spec = self.specs[name]
+        target = self.get_path(content_hash=content_hash, name=name)
+        if os.path.exists(target):
+            return target
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            if not self.is_worthwhile(filepath=filepath, name=name):
+                open(f"{target}.original", "w").close()
+                return None
+
+            audio = AudioSegment.from_file(filepath)
+            if spec["duration"]:
+                audio = audio[:spec["duration"] * 1000].fade_out(2000)  # Fixed-length preview clip
+            audio.export(f"{target}.tmp", format=spec["format"], codec=spec["codec"], bitrate=f"{spec['bitrate']}k")
+            os.replace(f"{target}.tmp", target)
+            print(f"Created {name} rendition of {filepath}")
+            return target
+        except Exception:
+            with self.lock:
+                self.failed.add(target)
+            raise
+
+    def _build_in_background(self, filepath: str, content_hash: str, name: str) -> None:
+        """
+        Builds a rendition on the worker thread and clears its in-progress flag.
+        """
+        try:
+            self.build(filepath=filepath, content_hash=content_hash, name=name)
+        finally:
+            with self.lock:
+                self.building.discard(self.get_path(content_hash=content_hash, name=name))
+
+    def get(self, filepath: str, content_hash: str, name: str) -> Optional[str]:
+        """
+        Returns the path of a rendition if it is in the cache. Otherwise, the rendition is scheduled to be built and
+        None is returned, meaning the original has to be served.
+        """
+        target = self.get_path(content_hash=content_hash, name=name)
+        if os.path.exists(target):
+            return target
+        if os.path.exists(f"{target}.original"):
+            return None
+
+        with self.lock:
+            if target not in self.building and target not in self.failed:
+                self.building.add(target)
+                self.executor.submit(self._build_in_background, filepath, content_hash, name)
+        return None
+
+
+rendition_cache = RenditionCache(
+    root_dir=VibesterConfig.path_renditions,
+    specs=VibesterConfig.renditions,
+    max_workers=VibesterConfig.rendition_workers,
+)
+
+
+if __name__ == "__main__":
+    # Builds every rendition of the whole library ahead of time, e.g. before an event.
+    from library import library_index
+
+    for _, music_relpath in library_index.items():
+        if not music_relpath.lower().endswith(tuple(VibesterConfig.supported_formats)):
+            continue
+        music_filepath = os.path.join(VibesterConfig.path_music, music_relpath)
+        music_hash = library_index.get_content_hash(relpath=music_relpath)
+        for rendition_name in VibesterConfig.renditions:
+            rendition_cache.build(filepath=music_filepath, content_hash=music_hash, name=rendition_name)
+    library_index.save()
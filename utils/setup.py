@@ -1,11 +1,19 @@
 import os
 import musicbrainzngs
+from loader import catalog
 from typing import Optional
+from urllib.parse import quote
+from library import library_index
 from config import VibesterConfig
 from user import User, UserManager
+from werkzeug.security import safe_join
+from utils.renditions import rendition_cache
+from concurrent.futures.process import BrokenProcessPool
+from pages.play.utils import find_track, get_music_source
 from pages.login.layout import get_layout as get_layout_login
-from flask_login import login_user, login_required, logout_user, LoginManager
-from flask import Flask, redirect, url_for, abort, send_file, send_from_directory
+from pages.play.scanner import scan_pool, ScanBusy, ScanSuperseded
+from flask_login import login_user, login_required, logout_user, current_user, LoginManager
+from flask import Flask, Response, request, jsonify, make_response, redirect, url_for, abort, send_file
 
 
 def setup_routes(server: Flask, user_manager: UserManager) -> None:
@@ -17,7 +25,7 @@ def setup_routes(server: Flask, user_manager: UserManager) -> None:
         """
         Flask login route.
         """
-        from flask import request, render_template_string
+        from flask import render_template_string
 
         if request.method == "POST":
             username = request.form["username"]
@@ -46,24 +54,116 @@ def setup_routes(server: Flask, user_manager: UserManager) -> None:
         logout_user()
         return redirect(url_for("login"))
 
-    @server.route("/music/<filename>")
+    def track_response(src: Optional[str], candidate: bool = False) -> Response:
+        """
+        Response of the card lookup routes. It carries the version of the catalog, so the play page knows when the
+        cards it has resolved before are outdated, and whether a code was seen that could not be decoded yet, so the
+        play page can sample faster for a while.
+        """
+        response = jsonify({"src": src}) if src is not None else make_response("", 204)
+        response.headers["X-Catalog-Version"] = catalog.get_version()
+        response.headers["X-Scan-Candidate"] = "1" if candidate else "0"
+        return response
+
+    @server.route("/scan", methods=["POST"])
+    @login_required
+    def scan():
+        """
+        Frame ingest route for the play page. The body is a single binary camera frame, either a compressed image or
+        raw 8-bit grayscale pixels with the frame size given as the width and height query parameters.
+        Responds with the source of the matched track or with an empty 204 response if there was no match.
+        Frames are decoded by the scan pool: a frame replaced by a newer one of the same session gets an empty 204
+        response marked as superseded and a 503 response is sent while the pool is saturated or a worker crashed.
+        """
+        if request.content_length is None or request.content_length > VibesterConfig.scan_max_frame_bytes:
+            abort(413)
+
+        try:
+            card_hash, bbox = scan_pool.scan(
+                session_id=f"{current_user.id}:{request.headers.get('X-Scan-Session', '')}",
+                frame=request.get_data(cache=False),
+                width=request.args.get("width", type=int),
+                height=request.args.get("height", type=int),
+            )
+        except ScanSuperseded:
+            response = make_response("", 204)
+            response.headers["X-Scan-Superseded"] = "1"
+            return response
+        except (ScanBusy, BrokenProcessPool):  # A worker that crashed is replaced for the next frame
+            response = make_response("", 503)
+            response.headers["Retry-After"] = "1"
+            return response
+        except ValueError:
+            abort(400)
+
+        src = find_track(card_hash=card_hash) if card_hash else None
+        return track_response(src=src, candidate=src is None and bbox is not None)
+
+    @server.route("/resolve/<card_hash>")
     @login_required
-    def serve_music(filename: str):
+    def resolve(card_hash: str):
         """
-        File serving route from the root directory of the music folder.
+        Resolves the hash of a card decoded in the browser to the source of its track.
+        Responds with an empty 204 response if there is no track for the hash.
         """
-        return send_from_directory(VibesterConfig.path_music, filename)
+        return track_response(src=find_track(card_hash=card_hash))
 
-    @server.route('/music/<path:subpath>')
-    def serve_music_recursive(subpath: str):
+    def send_music(relpath: str) -> Response:
         """
-        File serving route from the recursive subdirectories of the music folder.
+        Sends a music file. Range requests, ETag and Last-Modified validation are handled here unless the delivery is
+        offloaded to the fronting web server, in which case only the headers telling it which file to send are set.
+        Every rendition has its own address, given by get_music_source, so a player never gets the bytes of another
+        file than the one it started with. The address of the original only sends new downloads, which don't request
+        a byte range, on to the default rendition once it is ready. An address of a rendition whose file changed or
+        that is no longer in the cache is sent on to the current source.
         """
-        file_path = str(os.path.join(VibesterConfig.path_music, subpath))
-        if os.path.isfile(file_path):
-            return send_file(file_path, mimetype='audio/mpeg')
-        else:
+        filepath = safe_join(VibesterConfig.path_music, relpath)
+        if filepath is None or not os.path.isfile(filepath):
             abort(404)
+        accel_path = f"{VibesterConfig.music_accel_prefix}/{relpath}"
+
+        rendition = request.args.get("rendition")
+        if rendition is None:
+            if request.range is None and "If-Range" not in request.headers:
+                source = get_music_source(relpath=relpath)
+                if source != f"music/{quote(relpath)}":
+                    return redirect(f"/{source}")
+        elif rendition in VibesterConfig.renditions:
+            content_hash = library_index.get_content_hash(relpath=relpath)
+            rendition_path = rendition_cache.get(filepath=filepath, content_hash=content_hash, name=rendition)
+            if rendition_path is None or request.args.get("v") != content_hash:
+                return redirect(f"/{get_music_source(relpath=relpath, rendition=rendition)}")
+            filepath = rendition_path
+            accel_path = f"{VibesterConfig.renditions_accel_prefix}/{rendition}/{os.path.basename(rendition_path)}"
+        mimetype = VibesterConfig.music_mimetypes.get(os.path.splitext(filepath)[1].lower(), "application/octet-stream")
+
+        if VibesterConfig.music_sendfile is None:
+            response = send_file(filepath, mimetype=mimetype, conditional=True, etag=True,
+                                 max_age=VibesterConfig.music_max_age)
+            response.accept_ranges = "bytes"  # Advertised on full responses too, so players can seek
+        else:
+            stat = os.stat(filepath)
+            response = Response(mimetype=mimetype)
+            if VibesterConfig.music_sendfile == "x-accel":  # Nginx serves the file from an internal location
+                response.headers["X-Accel-Redirect"] = quote(accel_path)
+            else:  # Apache or lighttpd serves the file from its absolute path
+                response.headers["X-Sendfile"] = os.path.abspath(filepath)
+            response.last_modified = stat.st_mtime
+            response.set_etag(f"{stat.st_mtime}-{stat.st_size}")
+            response.cache_control.max_age = VibesterConfig.music_max_age
+            response = response.make_conditional(request)
+
+        response.cache_control.public = False  # Music is only served to logged-in users
+        response.cache_control.private = True
+        return response
+
+    @server.route("/music/<path:subpath>")
+    @login_required
+    def serve_music(subpath: str):
+        """
+        File serving route for the music folder and its subdirectories.
+        """
+        return send_music(relpath=subpath)
 
 
 def setup_login(login_manager: LoginManager, user_manager: UserManager) -> None:
@@ -98,6 +198,8 @@ def setup_folders(root_dir: str) -> None:
     """
     setup_folder(root_dir=root_dir, dir_to_create=VibesterConfig.path_music)
     setup_folder(root_dir=root_dir, dir_to_create=VibesterConfig.path_output)
+    setup_folder(root_dir=root_dir, dir_to_create=VibesterConfig.path_renditions)
+    setup_folder(root_dir=root_dir, dir_to_create=VibesterConfig.path_models)
     setup_folder(root_dir=root_dir, dir_to_create=VibesterConfig.path_cert)
     setup_folder(root_dir=root_dir, dir_to_create=os.path.dirname(VibesterConfig.path_db))
     setup_folder(root_dir=root_dir, dir_to_create=os.path.dirname(VibesterConfig.path_user))
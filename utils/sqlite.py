@@ -0,0 +1,15 @@
+import os
+import sqlite3
+
+
+def connect(filepath: str) -> sqlite3.Connection:
+    """
+    Opens a SQLite database in WAL mode, where readers are not blocked by a writer and a writer is not blocked by
+    readers. Connections must not be shared between threads.
+    """
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    connection = sqlite3.connect(filepath, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")  # Safe in WAL mode, only the last commits can be lost on a crash
+    return connection